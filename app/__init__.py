@@ -1,7 +1,7 @@
 import os
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
-from flask import Flask
+from flask import Flask, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
@@ -21,6 +21,9 @@ def storage_service() -> StorageService:
     Use this to manage storage throughout the app, given that storage will be s3 
     or some other service in deployment and local in development.
 
+    Returns the app's StorageService, created once in create_app, so every call 
+    shares the same S3 client and its connection pool.
+
     e.g.
     ```
     from app import storage_service
@@ -29,7 +32,14 @@ def storage_service() -> StorageService:
     storage.upload_json('path/to/file.json', {'key': 'value'})
     ```
     '''
-    return StorageService()
+    return current_app.extensions['storage']
+
+def archive_queue() -> 'ArchiveQueue':
+    '''
+    Use this to archive files (e.g. the data behind an AdminAction) without 
+    making the request wait for the upload. See app.archive.ArchiveQueue.
+    '''
+    return current_app.extensions['archive']
 
 def create_app(config_class=Config):
     app = Flask(__name__)
@@ -54,6 +64,11 @@ def create_app(config_class=Config):
 
     data_dir = app.config['DATA_DIR']
     os.makedirs(data_dir, exist_ok=True)
+    app.extensions['storage'] = StorageService(app)
+    from app.archive import ArchiveQueue
+    app.extensions['archive'] = ArchiveQueue(app)
+    from app.integrations.sheety import SheetyClient
+    app.extensions['sheety'] = SheetyClient(app)
 
     # logging and error emailing
     if not app.debug and not app.testing:
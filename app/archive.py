@@ -0,0 +1,135 @@
+import os
+import json
+import queue
+import shutil
+import tempfile
+from time import sleep
+from threading import Thread, Lock
+import pandas as pd
+from flask import current_app
+from app import db, storage_service
+from app.models import File
+
+class ArchiveQueue:
+    '''
+    Archives artifacts (DataFrames, PDFs, JSONL, text) in storage from a
+    background thread, so that requests don't wait for storage round trips.
+    When an upload is done, a File record is created for it.
+
+    Use archive_queue() to get the app's queue:
+    ```
+    from app import archive_queue
+
+    archive_queue().submit('captura/products.csv', df, admin_action_id=action.id)
+    ```
+
+    Queued artifacts live in memory only: jobs still waiting when the process
+    exits are lost.
+    '''
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_attempts = app.config['ARCHIVE_MAX_ATTEMPTS']
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = Lock()
+
+    def submit(self, path: str, payload, admin_action_id: int = None, 
+               on_archived=None) -> None:
+        '''
+        Queues payload to be archived (compressed and content-addressed, see 
+        StorageService.upload_archive). path is the file's name in its File 
+        record.
+
+        Params:
+        - payload: a DataFrame (uploaded as CSV), a list of dicts (uploaded as
+        JSONL), str, bytes or a binary file-like object. File objects are 
+        closed once processed.
+        - admin_action_id: AdminAction of the File record created once the 
+        upload succeeds, if any.
+        - on_archived: called with (storage key, content hash) once the upload 
+        succeeds, from the worker thread inside an app context.
+        '''
+        if isinstance(payload, pd.DataFrame):
+            payload = payload.copy() # the caller may keep modifying its DataFrame
+        self._queue.put({
+            'path': path,
+            'payload': payload,
+            'admin_action_id': admin_action_id,
+            'on_archived': on_archived,
+        })
+        self._ensure_worker()
+
+    def join(self) -> None:
+        '''Blocks until every queued artifact has been processed.'''
+        self._queue.join()
+
+    def _ensure_worker(self) -> None:
+        # started on first use rather than in create_app so that it runs in the
+        # process that serves requests (e.g. after gunicorn forks its workers)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                with self.app.app_context():
+                    self._archive(job)
+            except Exception as e:
+                self.app.logger.error(f"Could not archive {job['path']}: {e}")
+            finally:
+                if hasattr(job['payload'], 'close'):
+                    job['payload'].close()
+                self._queue.task_done()
+
+    def _archive(self, job: dict) -> None:
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                key, content_hash = archive(job['path'], job['payload'])
+                break
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    raise
+                current_app.logger.warning(
+                    f"Attempt {attempt}/{self.max_attempts} to archive {job['path']} failed: {e}")
+                sleep(2 ** attempt)
+
+        current_app.logger.info(f"Archived {job['path']} as {key}")
+        if job['on_archived'] is not None:
+            job['on_archived'](key, content_hash)
+        try:
+            db.session.add(File(path=job['path'], content_hash=content_hash, 
+                                storage_key=key, admin_action_id=job['admin_action_id']))
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+def archive(path: str, payload) -> tuple[str, str]:
+    '''
+    Stores any payload accepted by ArchiveQueue.submit() with 
+    StorageService.upload_archive(). The extension of path is kept in the key.
+
+    Returns (storage key, content hash).
+    '''
+    extension = os.path.splitext(path)[1].lstrip('.') or 'bin'
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as f:
+        if isinstance(payload, pd.DataFrame):
+            payload.to_csv(f, index=False, encoding='utf-8')
+        elif isinstance(payload, list):
+            for row in payload:
+                f.write((json.dumps(row) + '\n').encode('utf-8'))
+        elif isinstance(payload, str):
+            f.write(payload.encode('utf-8'))
+        elif isinstance(payload, (bytes, bytearray)):
+            f.write(payload)
+        else:
+            payload.seek(0) # in case a previous attempt read part of it
+            shutil.copyfileobj(payload, f)
+        f.seek(0)
+        return storage_service().upload_archive(f, extension)
@@ -8,6 +8,9 @@ from app import db
 from app.models import Vendor, User
 from app.utils import simple_lower_ascii
 from app.shop.bulk_processing import async_update_db
+from app.shop.batch_files import BatchFileError, inventory_updates_from_file
+from app.shop.captura import stage_captura, get_staged_captura, captura_cleanup_and_validation
+from app.shop.inventory import complete_sheety_data, write_local_inventory
 
 bp = Blueprint('cli', __name__)
 
@@ -177,4 +180,42 @@ def update_vendors():
     Asynchronously query shopify via a bulk operation and when the file is ready, 
     update the vendors table.
     '''
-    async_update_db()
\ No newline at end of file
+    async_update_db()
+
+@bp.cli.command('load-captura')
+@click.argument('file_path')
+def load_captura(file_path):
+    '''
+    Load the products of a CSV/XLSX file (same columns as the Captura worksheet)
+    to be reviewed and published from the Captura page instead of the worksheet.
+    '''
+    try:
+        with open(file_path, 'rb') as f:
+            total = stage_captura(f, file_path)
+    except BatchFileError as e:
+        print(e)
+        sys.exit(1)
+
+    products = captura_cleanup_and_validation(get_staged_captura()[0])
+    print(f"Loaded {total} products: {products['errors'].count()} with errors, "
+          f"{products['warnings'].count()} with warnings.")
+
+@bp.cli.command('load-cantidades')
+@click.argument('file_path')
+def load_cantidades(file_path):
+    '''
+    Load inventory updates from a CSV/XLSX file (same columns as the 
+    Actualizar Cantidades worksheet) to be reviewed and uploaded from the 
+    Actualizar Cantidades page.
+    '''
+    try:
+        with open(file_path, 'rb') as f:
+            updates = inventory_updates_from_file(f, file_path)
+    except BatchFileError as e:
+        print(e)
+        sys.exit(1)
+
+    df = complete_sheety_data(updates)
+    write_local_inventory(df)
+    total_errors = (df['errors'] != 'none').sum() if len(df) else 0
+    print(f'Loaded {len(df)} products: {total_errors} with errors.')
@@ -1,8 +1,10 @@
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from flask import render_template, abort, flash, redirect, url_for, request, current_app
 from flask_login import login_required, current_user
 import sqlalchemy as sa
+import sqlalchemy.orm as orm
 from app import db
+from app.pagination import keyset_paginate, estimate_count
 from app.dashboard import bp
 from app.models import User, AdminAction
 from app.dashboard.forms import UserSettingsForm
@@ -12,8 +14,15 @@ from time import sleep
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        # only written every LAST_SEEN_INTERVAL seconds, not on every request
+        now = datetime.now(timezone.utc)
+        last_seen = current_user.last_seen
+        if last_seen is not None and last_seen.tzinfo is None:
+            last_seen = last_seen.replace(tzinfo=timezone.utc) # as read from the db
+        interval = timedelta(seconds=current_app.config['LAST_SEEN_INTERVAL'])
+        if last_seen is None or now - last_seen >= interval:
+            current_user.last_seen = now
+            db.session.commit()
 
 @bp.route("/health")
 def health():
@@ -28,38 +37,40 @@ def index():
 @bp.route('/action-log')
 @login_required
 def action_log():
-    page = request.args.get('page', 1, int)
-    query = sa.select(AdminAction).order_by(AdminAction.timestamp.desc())
-    actions = db.paginate(query, page=page, error_out=False, 
-                          per_page=current_app.config['ADMIN_ACTIONS_PER_PAGE'])
+    query = sa.select(AdminAction).options(orm.joinedload(AdminAction.admin))
+    actions = keyset_paginate(query, [(AdminAction.timestamp, True), (AdminAction.id, True)],
+                              per_page=current_app.config['ADMIN_ACTIONS_PER_PAGE'],
+                              after=request.args.get('after'), 
+                              before=request.args.get('before'))
     
     pagination = {
-        'page': page,
+        'start': actions.start,
         'next_url': url_for('dashboard.action_log',
-                            page=actions.next_num) if actions.has_next else None,
+                            after=actions.next_cursor) if actions.has_next else None,
         'prev_url': url_for('dashboard.action_log', 
-                            page=actions.prev_num) if actions.has_prev else None,
+                            before=actions.prev_cursor) if actions.has_prev else None,
     }
 
     return render_template('dashboard/action_log.html', actions=actions.items, 
-                           pagination=pagination)
+                           pagination=pagination, total=estimate_count(AdminAction))
 
 @bp.route('/user/<id>')
 @login_required
 def user(id):
     user = db.first_or_404(sa.select(User).where(User.id == int(id)))
 
-    page = request.args.get('page', 1, int)
-    query = sa.select(AdminAction).where(AdminAction.admin == user).order_by(AdminAction.timestamp.desc())
-    actions = db.paginate(query, page=page, error_out=False, 
-                          per_page=current_app.config['ADMIN_ACTIONS_PER_PAGE'])
+    query = sa.select(AdminAction).where(AdminAction.admin == user)
+    actions = keyset_paginate(query, [(AdminAction.timestamp, True), (AdminAction.id, True)],
+                              per_page=current_app.config['ADMIN_ACTIONS_PER_PAGE'],
+                              after=request.args.get('after'), 
+                              before=request.args.get('before'))
     
     pagination = {
-        'page': page,
+        'start': actions.start,
         'next_url': url_for('dashboard.user', id=user.id,
-                            page=actions.next_num) if actions.has_next else None,
+                            after=actions.next_cursor) if actions.has_next else None,
         'prev_url': url_for('dashboard.user', id=user.id, 
-                            page=actions.prev_num) if actions.has_prev else None,
+                            before=actions.prev_cursor) if actions.has_prev else None,
     }
 
     return render_template('dashboard/user.html', user=user, 
@@ -68,20 +79,24 @@ def user(id):
 @bp.route('/users')
 @login_required
 def users():
-    page = request.args.get('page', 1, int)
-    query = sa.select(User).order_by(User.is_superadmin.desc(), User.last_seen.desc())
-    all_users = db.paginate(
-        query, page=page, per_page=current_app.config['ADMIN_ACTIONS_PER_PAGE'])
+    never = datetime(1970, 1, 1) # users that never logged in go last
+    keys = [(User.is_superadmin, True), 
+            (sa.func.coalesce(User.last_seen, never), True), 
+            (User.id, True)]
+    all_users = keyset_paginate(sa.select(User), keys, 
+                                per_page=current_app.config['ADMIN_ACTIONS_PER_PAGE'],
+                                after=request.args.get('after'), 
+                                before=request.args.get('before'))
 
     pagination = {
-        'page': page,
-        'next_url': url_for('dashboard.user', id=user.id,
-                            page=all_users.next_num) if all_users.has_next else None,
-        'prev_url': url_for('dashboard.user', id=user.id, 
-                            page=all_users.prev_num) if all_users.has_prev else None,
+        'start': all_users.start,
+        'next_url': url_for('dashboard.users', 
+                            after=all_users.next_cursor) if all_users.has_next else None,
+        'prev_url': url_for('dashboard.users', 
+                            before=all_users.prev_cursor) if all_users.has_prev else None,
     }
     
-    return render_template('dashboard/users.html', users=all_users, 
+    return render_template('dashboard/users.html', users=all_users.items, 
                            pagination=pagination)
 
 @bp.route('/settings', methods=['GET', 'POST'])
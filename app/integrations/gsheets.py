@@ -1,16 +1,80 @@
+from threading import Lock
 import pandas as pd
 import gspread
+from cachetools import TTLCache
 from google.oauth2.service_account import Credentials
 from flask import current_app
 
+# One client per process: its credentials keep their access token until it 
+# expires, so they are not re-authorized on every call.
+_client = None
+_client_lock = Lock()
+# Opened spreadsheets and worksheets are reused for GSHEETS_HANDLE_TTL seconds 
+# to skip the metadata requests made when opening them.
+_handles = None
+_handles_lock = Lock()
+# Last DataFrame read by read_if_changed() for each key, with the spreadsheet's 
+# modifiedTime at the moment it was read.
+_reads = {}
+_reads_lock = Lock()
+# Last modifiedTime seen for each spreadsheet. When it changes, the cached 
+# headers of its worksheets are dropped, as someone may have edited them.
+_modified_times = {}
+
+def get_client() -> gspread.Client:
+    global _client
+    with _client_lock:
+        if _client is None:
+            creds = Credentials.from_service_account_info(
+                current_app.config.get('GSHEETS_CREDENTIALS'),
+                scopes = ["https://www.googleapis.com/auth/spreadsheets",
+                          # for the modifiedTime used by read_if_changed()
+                          "https://www.googleapis.com/auth/drive.metadata.readonly"])
+            _client = gspread.authorize(creds)
+    return _client
+
+def _get_handle(key: tuple, open_handle):
+    '''Returns the cached handle for key, or opens it with open_handle() and caches it.'''
+    global _handles
+    with _handles_lock:
+        if _handles is None:
+            _handles = TTLCache(maxsize=64, ttl=current_app.config['GSHEETS_HANDLE_TTL'])
+        handle = _handles.get(key)
+    if handle is None:
+        handle = open_handle()
+        _set_handle(key, handle)
+    return handle
+
+def _set_handle(key: tuple, handle) -> None:
+    with _handles_lock:
+        if _handles is not None:
+            _handles[key] = handle
+
+def get_spreadsheet(spreadsheet_id) -> gspread.spreadsheet.Spreadsheet:
+    return _get_handle((spreadsheet_id,), 
+                       lambda: get_client().open_by_key(spreadsheet_id))
+
 def connect_to_gsheet(spreadsheet_id, sheet_name) -> gspread.worksheet.Worksheet: 
-    creds = Credentials.from_service_account_info(
-        current_app.config.get('GSHEETS_CREDENTIALS'),
-        scopes = ["https://www.googleapis.com/auth/spreadsheets"])
-    client = gspread.authorize(creds)
-    ss = client.open_by_key(spreadsheet_id)
-    
-    return ss.worksheet(sheet_name)
+    return _get_handle((spreadsheet_id, sheet_name), 
+                       lambda: get_spreadsheet(spreadsheet_id).worksheet(sheet_name))
+
+def _forget_handle(key: tuple) -> None:
+    with _handles_lock:
+        if _handles is not None:
+            _handles.pop(key, None)
+
+def _forget_headers(spreadsheet_id) -> None:
+    with _handles_lock:
+        if _handles is not None:
+            for key in [key for key in _handles 
+                        if key[0] == spreadsheet_id and key[-1] == 'headers']:
+                _handles.pop(key, None)
+
+def forget_gsheet_handles() -> None:
+    '''Drops cached spreadsheet and worksheet handles, e.g. after renaming a sheet.'''
+    with _handles_lock:
+        if _handles is not None:
+            _handles.clear()
 
 def get_sheet_data(spreadsheet_id, sheet_name, include_row_num=False) -> list[dict]:
     """Returns listt of dicts where keys are column headers (first row)."""
@@ -24,53 +88,161 @@ def get_sheet_data(spreadsheet_id, sheet_name, include_row_num=False) -> list[di
     return data 
 
 def get_sheet_as_dataframe(spreadsheet_id, sheet_name, include_row_num=False) -> pd.DataFrame:
-    data = get_sheet_data(spreadsheet_id, sheet_name, include_row_num)
-    return pd.DataFrame(data)
+    """Only downloads the worksheet if the spreadsheet changed since the last call."""
+    return read_if_changed(('gsheets', spreadsheet_id, sheet_name, include_row_num), 
+                           spreadsheet_id,
+                           lambda: pd.DataFrame(get_sheet_data(spreadsheet_id, sheet_name, include_row_num)))
+
+def get_modified_time(spreadsheet_id) -> str | None:
+    """
+    Returns the Drive modifiedTime of a spreadsheet, or None if it can't be 
+    read (e.g. the Drive API is not enabled for the service account's project).
+    """
+    try:
+        modified_time = get_spreadsheet(spreadsheet_id).get_lastUpdateTime()
+    except (gspread.exceptions.APIError, KeyError) as e:
+        current_app.logger.warning(f'Could not get the modified time of spreadsheet {spreadsheet_id}: {e}')
+        return None
+
+    with _reads_lock:
+        changed = _modified_times.get(spreadsheet_id) != modified_time
+        _modified_times[spreadsheet_id] = modified_time
+    if changed:
+        _forget_headers(spreadsheet_id)
+    return modified_time
+
+def read_if_changed(key: tuple, spreadsheet_id, read) -> pd.DataFrame:
+    """
+    Returns a copy of the DataFrame returned by the last read() for this key if 
+    the spreadsheet has not been modified since. Otherwise calls read() again.
+    If the modified time is not available read() is always called.
+
+    read can fetch the data any way (e.g. through Sheety) as long as it comes 
+    from the given spreadsheet.
+    """
+    modified_time = get_modified_time(spreadsheet_id)
+    with _reads_lock:
+        cached = _reads.get(key)
+    if modified_time and cached and cached[0] == modified_time:
+        current_app.logger.debug(f'Spreadsheet unchanged since {modified_time}, using cached data.')
+        return cached[1].copy()
+
+    # modified_time was taken before reading, so data that changes while it is 
+    # read is read again next time
+    df = read()
+    if modified_time:
+        with _reads_lock:
+            _reads[key] = (modified_time, df.copy())
+    return df
+
+def get_headers(spreadsheet_id, sheet_name) -> list[str]:
+    """
+    Returns the first row of a worksheet. Cached like the worksheet handles, 
+    until a SheetBatch changes it or get_modified_time() sees the spreadsheet 
+    was modified.
+    """
+    headers = _get_handle((spreadsheet_id, sheet_name, 'headers'), 
+                          lambda: connect_to_gsheet(spreadsheet_id, sheet_name).row_values(1))
+    return list(headers)
+
+def cell_data(value) -> dict:
+    """A value as Sheets API CellData. Empty strings give an empty cell."""
+    if isinstance(value, bool):
+        return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, (int, float)):
+        return {'userEnteredValue': {'numberValue': value}}
+    if value == '':
+        return {}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+class SheetBatch:
+    """
+    Collects writes to the worksheets of one spreadsheet and sends all of them 
+    in a single batchUpdate request, which Sheets applies atomically.
+
+    e.g.
+    ```
+    batch = SheetBatch(spreadsheet_id)
+    batch.append_df('Historial', df)
+    batch.clear_except_header('Captura')
+    batch.commit()
+    ```
+    """
+    def __init__(self, spreadsheet_id):
+        self.spreadsheet_id = spreadsheet_id
+        self.requests = []
+        self.new_headers = {} # sheet name: headers after this batch
+        self.resized_sheets = set()
+
+    def append_df(self, sheet_name, df: pd.DataFrame) -> 'SheetBatch':
+        """
+        Appends df rows after the last row with data. Missing columns are added 
+        to the first row if needed. Only the header row is read.
+        """
+        sheet = connect_to_gsheet(self.spreadsheet_id, sheet_name)
+        headers = self.new_headers.get(sheet_name) or get_headers(self.spreadsheet_id, sheet_name)
+
+        # Ensure all columns exist in the sheet
+        new_columns = [col for col in df.columns.tolist() if col not in headers]
+        if new_columns:
+            if len(headers) + len(new_columns) > sheet.col_count:
+                self.requests.append({'appendDimension': {
+                    'sheetId': sheet.id,
+                    'dimension': 'COLUMNS',
+                    'length': len(headers) + len(new_columns) - sheet.col_count,
+                }})
+                self.resized_sheets.add(sheet_name)
+            self.requests.append({'updateCells': {
+                'start': {'sheetId': sheet.id, 'rowIndex': 0, 'columnIndex': len(headers)},
+                'rows': [{'values': [cell_data(col) for col in new_columns]}],
+                'fields': 'userEnteredValue',
+            }})
+            headers = headers + new_columns
+            self.new_headers[sheet_name] = headers
+
+        # reorder DataFrame columns to match the sheet's
+        ordered_df = df.reindex(columns=headers, fill_value="")
+        ordered_df = ordered_df.fillna("") # remove nan to avoid errors
+        if len(ordered_df):
+            self.requests.append({'appendCells': {
+                'sheetId': sheet.id,
+                'rows': [{'values': [cell_data(value) for value in row]} 
+                         for row in ordered_df.values.tolist()],
+                'fields': 'userEnteredValue',
+            }})
+        return self
+
+    def clear_except_header(self, sheet_name) -> 'SheetBatch':
+        """Clears the values of every row but the first one (headers)."""
+        sheet = connect_to_gsheet(self.spreadsheet_id, sheet_name)
+        self.requests.append({'updateCells': {
+            'range': {'sheetId': sheet.id, 'startRowIndex': 1},
+            'fields': 'userEnteredValue',
+        }})
+        return self
+
+    def commit(self) -> None:
+        if not self.requests:
+            return
+        get_spreadsheet(self.spreadsheet_id).batch_update({'requests': self.requests})
+        self.requests = []
+
+        for sheet_name, headers in self.new_headers.items():
+            _set_handle((self.spreadsheet_id, sheet_name, 'headers'), headers)
+        for sheet_name in self.resized_sheets:
+            # reopened on next use, to get the new column count
+            _forget_handle((self.spreadsheet_id, sheet_name))
+        self.resized_sheets = set()
 
 def append_df_to_sheet(spreadsheet_id, sheet_name, df: pd.DataFrame) -> None:
     """
     Appends df rows to a worksheet.
     Missing columns are added to the first row if needed.
     """
-    sheet = connect_to_gsheet(spreadsheet_id, sheet_name)
-    existing_data = sheet.get_all_values()
-    
-    if existing_data:
-        existing_headers = existing_data[0]
-    else:
-        existing_headers = []
-    
-    df_columns = df.columns.tolist()
-    
-    # Ensure all columns exist in the sheet
-    new_columns = [col for col in df_columns if col not in existing_headers]
-    if new_columns:
-        existing_headers.extend(new_columns)
-        sheet.update('A1', [existing_headers])
-    
-    # reorder DataFrame columns to match the sheet's
-    ordered_df = df.reindex(columns=existing_headers, fill_value="")
-
-    next_row = len(existing_data) + 1
-    
-    # Ensure there are enough rows in the sheet
-    current_row_count = len(existing_data)
-    required_rows = len(ordered_df) + next_row - 1
-    if required_rows > current_row_count:
-        sheet.add_rows(required_rows - current_row_count)
-    
-    # Append from first empty row
-    ordered_df = ordered_df.fillna("") # remove nan to avoid errors
-    sheet.update(f'A{next_row}', ordered_df.values.tolist())
+    SheetBatch(spreadsheet_id).append_df(sheet_name, df).commit()
 
 def clear_sheet_except_header(spreadsheet_id, sheet_name) -> None:
     """
     Clears all content in a worksheet except for the first row (headers).
     """
-    sheet = connect_to_gsheet(spreadsheet_id, sheet_name)
-    existing_data = sheet.get_all_values()
-    
-    if existing_data:
-        headers = existing_data[0]
-        sheet.clear()
-        sheet.update('A1', [headers])
+    SheetBatch(spreadsheet_id).clear_except_header(sheet_name).commit()
@@ -1,40 +1,135 @@
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import current_app
+from app.integrations.gsheets import read_if_changed
+
+# Columns of each sheet and their pandas dtypes. Sheety leaves out a column when
+# no row has a value for it, so every column listed here is always in the
+# DataFrames returned by SheetyClient.fetch().
+SHEET_SCHEMAS = {
+    ('etiquetas', 'etiquetas'): {
+        'id': 'Int64',
+        'sku': 'string',
+        'precio': 'Float64',
+        'cantidad': 'Int64',
+    },
+    ('actualizarCantidades', 'cantidades'): {
+        'id': 'Int64',
+        'clave (sku)': 'string',
+        'cantidadAAgregar': 'Int64',
+        'nuevoPrecioVenta': 'Float64',
+        'nuevoPrecioCompra': 'Float64',
+        'fechaDeCompra (yyyyMmDd)': 'string',
+    },
+}
+
+class SheetyClient:
+    '''
+    Client for the Sheety API. Create one per app (see create_app) and reuse it:
+    its session keeps connections open between calls and retries failed requests.
+
+    Use sheety_client() to get the app's client.
+    '''
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.base_url = f"https://api.sheety.co/{app.config['SHEETY_USERNAME']}"
+        self.timeout = (5, app.config['SHEETY_TIMEOUT'])
+
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f"Bearer {app.config['SHEETY_BEARER']}"
+        retries = Retry(total=3, backoff_factor=1,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=('GET', 'PUT'))
+        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+
+    def fetch(self, spreadsheet_name: str, sheet_name: str,
+              filters: dict = None) -> pd.DataFrame:
+        '''
+        Returns the rows of a sheet. If the sheet is in SHEET_SCHEMAS, the
+        DataFrame has all of its columns with their dtypes (see apply_schema).
+
+        Params:
+        - filters: only return rows where column == value, e.g. {'sku': 'ABC12'}
+        '''
+        url = self.base_url + f"/{spreadsheet_name}/{sheet_name}"
+        params = {f'filter[{column}]': value for column, value in (filters or {}).items()}
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+
+        df = pd.DataFrame(response.json().get(sheet_name, []))
+        schema = SHEET_SCHEMAS.get((spreadsheet_name, sheet_name))
+        return apply_schema(df, schema) if schema else df
+
+    def put(self, spreadsheet_name: str, sheet_name: str, row: int, payload: dict) -> bool:
+        '''Returns True if response is 200'''
+        url = self.base_url + f"/{spreadsheet_name}/{sheet_name}/{row}"
+        res = self.session.put(url, json=payload, timeout=self.timeout)
+        return res.status_code == 200
+
+def sheety_client() -> SheetyClient:
+    return current_app.extensions['sheety']
+
+def apply_schema(df: pd.DataFrame, schema: dict) -> pd.DataFrame:
+    '''
+    Adds missing schema columns and converts them to their dtypes. Empty strings
+    become missing values.
+
+    Values that can't be converted (e.g. text in a number column) are set as
+    missing and the names of their columns are listed in an extra
+    'invalidColumns' column, so they can still be reported as errors.
+    '''
+    df = df.reindex(columns=list(dict.fromkeys([*schema, *df.columns])))
+    df = df.replace('', None)
+    invalid = pd.Series([[] for _ in range(len(df))], index=df.index, dtype=object)
+
+    for column, dtype in schema.items():
+        values = df[column]
+        if dtype in ('Int64', 'Float64'):
+            numbers = pd.to_numeric(values, errors='coerce')
+            failed = numbers.isna() & values.notna()
+            if dtype == 'Int64':
+                failed |= numbers.notna() & (numbers % 1 != 0)
+            df[column] = numbers.where(~failed).astype(dtype)
+            for i in failed[failed].index:
+                invalid[i].append(column)
+        else:
+            df[column] = values.astype(dtype)
+
+    df['invalidColumns'] = invalid
+    return df
 
 def fetch_sheet_data(spreadsheet_name, sheet_name) -> pd.DataFrame:
     """
     Fetch from the Sheety API the info necessary to generate price tags pdf.
     """
-    base_url = f"https://api.sheety.co/{current_app.config['SHEETY_USERNAME']}"
-    headers = {
-        "Authorization": f"Bearer {current_app.config['SHEETY_BEARER']}"
-    } # TODO: these two variables should be outside this function, as they are 
-      # also used in put_record. but when I do that the app breaks.
-      # How to access config variables during initialization?
-
-    url = base_url + f"/{spreadsheet_name}/{sheet_name}"
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return pd.DataFrame(response.json().get(sheet_name, [])) #TODO: make sure all columns are in the dataframe because if no values are entered for a column sheety does not return it (since no record contains the field)
+    return sheety_client().fetch(spreadsheet_name, sheet_name)
 
 def fetch_etiquetas():
-    return fetch_sheet_data('etiquetas', 'etiquetas')
+    spreadsheet_id = current_app.config['GSHEETS_ETIQUETAS_ID']
+    if not spreadsheet_id:
+        return fetch_sheet_data('etiquetas', 'etiquetas')
+    # skip the Sheety request if the spreadsheet behind it has not changed
+    return read_if_changed(('sheety', 'etiquetas', 'etiquetas'), spreadsheet_id,
+                           lambda: fetch_sheet_data('etiquetas', 'etiquetas'))
 
 def fetch_inventory_updates():
-    return fetch_sheet_data('actualizarCantidades', 'cantidades')
+    spreadsheet_id = current_app.config['GSHEETS_CANTIDADES_ID']
+    if not spreadsheet_id:
+        return fetch_sheet_data('actualizarCantidades', 'cantidades')
+    # skip the Sheety request if the spreadsheet behind it has not changed
+    return read_if_changed(('sheety', 'actualizarCantidades', 'cantidades'), spreadsheet_id,
+                           lambda: fetch_sheet_data('actualizarCantidades', 'cantidades'))
 
 def put_record(spreadsheet_name:str, sheet_name:str, row:int, payload:dict) -> bool:
     """
     Returns True if response is 200
     """
-    base_url = f"https://api.sheety.co/{current_app.config['SHEETY_USERNAME']}"
-    headers = {
-        "Authorization": f"Bearer {current_app.config['SHEETY_BEARER']}"
-    }
-    url = base_url + f"/{spreadsheet_name}/{sheet_name}/{row}"
-    res = requests.put(url, headers=headers, json=payload)
-    return res.status_code == 200
+    return sheety_client().put(spreadsheet_name, sheet_name, row, payload)
 
 def clear_inventory_updates_sheet():
     payload = {
@@ -1,4 +1,8 @@
-from time import sleep
+import re
+import json
+from time import sleep, monotonic
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, Future
 import requests
 from requests.exceptions import HTTPError, ConnectionError, Timeout, RequestException
 from flask import current_app
@@ -14,12 +18,120 @@ class ShopifyQueryError(Exception):
     Usually response.json() will contain field 'errors'.
     """
     pass
+class ShopifyThrottledError(ShopifyQueryError):
+    """
+    The query was rejected because the cost bucket didn't have its requested 
+    cost available. It was not run, so it is safe to send it again.
+    """
+    pass
 class ShopifyUserError(Exception):
     """
     Custom exception for errors in Shopify GraphQL mutations where 'userErrors'
     list exists and is not empty.
     """
     pass
+
+class ThrottleBudget:
+    """
+    Local estimate of the store's GraphQL cost bucket (leaky bucket), shared by 
+    every thread in the process so that concurrent requests don't overdraw it.
+
+    The estimate is corrected with the 'throttleStatus' of every response and 
+    refills at the restore rate between responses.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.available = None # unknown until the first response
+        self.maximum = None
+        self.restore_rate = None
+        self.updated_at = monotonic()
+        # cost per node of each paginated query seen (see record_page):
+        # key: {'requested': float, 'actual': float}
+        self.page_costs = {}
+
+    def _current(self, now: float) -> float:
+        if self.available is None:
+            return float('inf')
+        refilled = self.available + (now - self.updated_at) * self.restore_rate
+        return min(self.maximum, refilled)
+
+    def update(self, throttle_status: dict) -> None:
+        with self._lock:
+            self.available = throttle_status['currentlyAvailable']
+            self.maximum = throttle_status['maximumAvailable']
+            self.restore_rate = throttle_status['restoreRate']
+            self.updated_at = monotonic()
+
+    def acquire(self, cost: float, required: float = None) -> None:
+        """
+        Blocks until `cost` points are (estimated to be) available, then reserves 
+        them. 
+        
+        Shopify only runs a query if its requested cost is available, but then 
+        takes its actual cost. Pass the requested cost as `required` to wait for 
+        it while reserving only the (expected) actual cost.
+        """
+        required = max(cost, required or 0)
+        while True:
+            with self._lock:
+                now = monotonic()
+                current = self._current(now)
+                if current >= required or current >= self.maximum:
+                    if self.available is not None:
+                        self.available = current - cost
+                        self.updated_at = now
+                    return
+                wait_time = (required - current) / self.restore_rate
+            sleep(wait_time)
+
+    def record_page(self, key, page_size: int, nodes: int, 
+                    requested: float, actual: float) -> None:
+        """
+        Learns the cost per node of a paginated query from one of its responses. 
+        `page_size` nodes were asked for (what requestedQueryCost is computed 
+        from) and `nodes` were returned (what actualQueryCost depends on).
+        """
+        requested = requested / page_size
+        actual = actual / max(nodes, 1)
+        with self._lock:
+            costs = self.page_costs.get(key)
+            if costs is None:
+                self.page_costs[key] = {'requested': requested, 'actual': actual}
+            else:
+                # requested is the same for every page of the same size, actual 
+                # changes with the data: average it over the last pages
+                costs['requested'] = requested
+                costs['actual'] = (costs['actual'] + actual) / 2
+
+    def page_size(self, key, default: int, max_page_size: int, max_cost: float) -> int:
+        """
+        Largest page size whose requested cost fits in max_cost and in the 
+        bucket, according to the costs recorded for key. Returns default if 
+        nothing has been recorded. Each request costs a few points more than 
+        its nodes, so fewer, larger pages get more nodes per point.
+        """
+        with self._lock:
+            costs = self.page_costs.get(key)
+            if costs is None:
+                return default
+            limit = min(max_cost, self.maximum or max_cost)
+        return max(1, min(max_page_size, int(limit / costs['requested'])))
+
+    def page_cost(self, key, page_size: int) -> dict | None:
+        """Estimated {'requested', 'actual'} cost of a page of key, or None if unknown."""
+        with self._lock:
+            costs = self.page_costs.get(key)
+            if costs is None:
+                return None
+            return {'requested': costs['requested'] * page_size, 
+                    'actual': costs['actual'] * page_size}
+
+throttle_budget = ThrottleBudget()
+# Reads being sent by graphql_query(): (query, variables json): Future
+_in_flight = {}
+_in_flight_lock = Lock()
+# Shopify rejects queries with a higher requested cost
+MAX_QUERY_COST = 1000
     
 def graphql_query(query: str, variables: dict = None) -> requests.Response:
     """
@@ -30,6 +142,48 @@ def graphql_query(query: str, variables: dict = None) -> requests.Response:
     If doing mutations: 
     this function checks for errors BUT NOT for 'userErrors' in Shopify GraphQL 
     mutations. For that you can use raise_for_user_errors() instead.
+
+    Identical reads (same query and variables) made while one is already in 
+    flight in this process wait for it and get the same response (or error) 
+    instead of sending their own request. Mutations are always sent.
+    """
+    if is_mutation(query):
+        return _send_graphql_query(query, variables)
+
+    key = (query, json.dumps(variables, sort_keys=True))
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = _in_flight[key] = Future()
+    if not leader:
+        current_app.logger.debug('Identical query in flight, waiting for its response.')
+        return future.result()
+
+    try:
+        res = _send_graphql_query(query, variables)
+        future.set_result(res)
+        return res
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+def is_mutation(query: str) -> bool:
+    """True if the first operation of the GraphQL document is a mutation."""
+    # skip comments, e.g. '# comment \n mutation {...}'
+    document = re.sub(r'#[^\n]*', '', query).lstrip()
+    return document.startswith('mutation')
+
+def _send_graphql_query(query: str, variables: dict = None, 
+                        retry_throttled: bool = True) -> requests.Response:
+    """
+    Sends a query, retrying it when it is throttled (unless retry_throttled is 
+    False, for callers that retry on their own) and, if it is not a mutation, 
+    after server, connection and timeout errors. When throttled it waits for 
+    the budget to be restored before retrying or raising.
     """
     STORE = current_app.config['SHOPIFY_STORE']
     API_TOKEN = current_app.config['SHOPIFY_API_TOKEN']
@@ -47,6 +201,11 @@ def graphql_query(query: str, variables: dict = None) -> requests.Response:
     else:
         payload = { 'query': query }
     
+    # A mutation that fails with a server, connection or timeout error may have 
+    # been applied anyway, and applying some of them twice (e.g. quantity 
+    # adjustments) is wrong: they are only sent again when throttled.
+    mutation = is_mutation(query)
+
     try_again, try_count = True, 0
     while try_again:
         try_again=False
@@ -57,24 +216,33 @@ def graphql_query(query: str, variables: dict = None) -> requests.Response:
                                 timeout=(5, 15))
             res.raise_for_status()
 
-            if res.json().get('errors'):
-                raise ShopifyQueryError(f'There was an error with the GraphQL query: {str(res.json()['errors'])}')
+            errors = res.json().get('errors')
+            if errors:
+                if all(error.get('extensions', {}).get('code') == 'THROTTLED' for error in errors):
+                    raise ShopifyThrottledError(f'The GraphQL query was throttled: {str(errors)}')
+                raise ShopifyQueryError(f'There was an error with the GraphQL query: {str(errors)}')
 
         except HTTPError as e:
             if res.status_code == 429:
                 try_again = True
                 sleep(2)
                 current_app.logger.warning("429 Response: Too many requests. Waiting 2 seconds...")
-                if try_count >= 5:
+                if not retry_throttled or try_count >= 5:
                     raise
             elif res.status_code < 500:
                 current_app.logger.error(f"HTTP client error occurred: {e}")
                 raise
+            elif mutation:
+                current_app.logger.error(f"HTTP server error occurred, the mutation is not sent again. Error: {e}")
+                raise
             else:
                 current_app.logger.warning(f"HTTP server error occurred, will try again in 3 seconds. Error: {e}") 
                 try_again = True
                 sleep(3)
         except ConnectionError as e:
+            if mutation:
+                current_app.logger.error(f"Connection error occurred, the mutation is not sent again: {e}")
+                raise
             current_app.logger.warning(f"Connection error occurred. Trying again in 3 seconds: {e}")
             sleep(3)
             try_again = True
@@ -82,11 +250,18 @@ def graphql_query(query: str, variables: dict = None) -> requests.Response:
                 raise
         except Timeout as e:
             current_app.logger.warning(f"Timeout error occurred: {e}")
-            if try_count >= 2:
+            if mutation or try_count >= 2:
                 raise
+            try_again = True
         except RequestException as e:
             current_app.logger.error(f"An error occurred: {e}")
             raise
+        except ShopifyThrottledError as e:
+            current_app.logger.warning(f"Query throttled: {e}")
+            throttle_management(res, default_seconds=2)
+            if not retry_throttled or try_count >= 5:
+                raise
+            try_again = True
         except ShopifyQueryError as e:
             current_app.logger.error(f"GraphQL query error occured: {e}")
             raise
@@ -123,6 +298,7 @@ def throttle_management(response: requests.Response, default_seconds=0):
         requested_query_cost = query_cost_info['requestedQueryCost']
         available = query_cost_info['throttleStatus']['currentlyAvailable']
         restore_rate = query_cost_info['throttleStatus']['restoreRate']
+        throttle_budget.update(query_cost_info['throttleStatus'])
         
         if requested_query_cost > available:
             wait_time = (requested_query_cost - available) // restore_rate + 1
@@ -135,6 +311,132 @@ def throttle_management(response: requests.Response, default_seconds=0):
         current_app.logger.warning("No query cost info in response, skipping throttle management. Waiting for the default time.")
         sleep(default_seconds)
 
+def run_mutation_batches(query: str, variables_list: list[dict], 
+                         queried_field: str, cost: float = 10, 
+                         max_workers: int = 4, max_attempts: int = 3) -> list[dict]:
+    """
+    Sends the same mutation once for every variables dict in `variables_list`, 
+    concurrently, reserving `cost` points from the throttle budget before each 
+    request. Requests that were throttled (not run) are sent up to 
+    `max_attempts` times in total: this is the only place they are retried. Other failures are not: after a connection, server or 
+    timeout error the mutation may have been applied, and sending it again 
+    could apply it twice. User errors are not retried either, since sending the 
+    same input again would fail the same way.
+
+    Returns one result per variables dict, in the same order:
+    {
+        "variables": the variables sent,
+        "response": requests.Response | None,
+        "userErrors": list of userErrors (empty if the mutation succeeded),
+        "error": str | None  # set if the request itself failed; it may still 
+                             # have been applied unless it was throttled
+    }
+    """
+    app = current_app._get_current_object()
+
+    def send(variables: dict) -> dict:
+        result = {'variables': variables, 'response': None, 'userErrors': [], 'error': None}
+        with app.app_context():
+            for attempt in range(1, max_attempts + 1):
+                throttle_budget.acquire(cost)
+                try:
+                    # graphql_query() would also retry throttled requests
+                    res = _send_graphql_query(query, variables, retry_throttled=False)
+                    result['response'] = res
+                    result['userErrors'] = res.json()['data'][queried_field]['userErrors']
+                    result['error'] = None
+                    break
+                except Exception as e:
+                    throttled = isinstance(e, ShopifyThrottledError) or (
+                        isinstance(e, HTTPError) and e.response is not None 
+                        and e.response.status_code == 429)
+                    if throttled:
+                        result['error'] = str(e)
+                        # _send_graphql_query() already waited for the budget
+                        current_app.logger.warning(
+                            f"Attempt {attempt}/{max_attempts} of {queried_field} throttled: {e}")
+                        continue
+                    if isinstance(e, ShopifyQueryError): # rejected, so not applied
+                        result['error'] = str(e)
+                    else:
+                        result['error'] = f'The request failed and may have been applied anyway: {e}'
+                    current_app.logger.error(f"{queried_field} failed, not sending it again: {e}")
+                    break
+        return result
+
+    if not variables_list:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(variables_list))) as executor:
+        return list(executor.map(send, variables_list))
+
+def iter_connection(query: str, variables: dict, path: list[str],
+                    after: str = None, page_size: int = 50,
+                    max_page_size: int = 250, max_cost: float = MAX_QUERY_COST):
+    """
+    Yields the nodes of a paginated connection one by one, requesting the next
+    page (with the query's `$first` and `$after` variables) only when the
+    previous one has been consumed, until there are no pages left.
+
+    Page sizes are tuned per query: the first page ever requested for a query 
+    has page_size nodes. Then the cost per node of every response is recorded 
+    in throttle_budget (shared by all threads and requests), and pages are as 
+    large as possible with a requested cost under max_cost.
+
+    Params:
+    - path: keys from the response's 'data' to the connection, e.g.
+    ['products'] or ['product', 'variants']
+    - after: cursor to start from (pageInfo.endCursor of a previous page)
+
+    e.g.
+    ```
+    for product in iter_connection(q.get_variants_from_products_query,
+                                   {'query': "vendor:'Juan'", 'locationId': location_id},
+                                   ['products']):
+        ...
+    ```
+    """
+    key = (query, tuple(path))
+    while True:
+        first = throttle_budget.page_size(key, page_size, max_page_size, max_cost)
+        estimate = throttle_budget.page_cost(key, first)
+        if estimate:
+            throttle_budget.acquire(estimate['actual'], required=estimate['requested'])
+        res = graphql_query(query, {**variables, 'first': first, 'after': after}).json()
+
+        connection = res['data']
+        for name in path:
+            connection = connection.get(name) if connection else None
+        if not connection:
+            return
+
+        cost = res.get('extensions', {}).get('cost')
+        if cost:
+            requested = cost['requestedQueryCost']
+            throttle_budget.record_page(key, first, len(connection['nodes']), requested,
+                                        cost.get('actualQueryCost') or requested)
+        yield from connection['nodes']
+
+        page_info = connection['pageInfo']
+        if not page_info['hasNextPage']:
+            return
+        after = page_info['endCursor']
+
+def user_error_indices(user_errors: list[dict], list_field: str) -> set[int] | None:
+    """
+    Returns the positions of the input list items that caused the given 
+    userErrors, e.g. field ["metafields", "3", "value"] -> {3}. 
+    Returns None if any of the errors can't be traced back to a single item.
+    """
+    indices = set()
+    for error in user_errors:
+        field = error.get('field') or []
+        try:
+            position = field.index(list_field)
+            indices.add(int(field[position + 1]))
+        except (ValueError, IndexError, TypeError):
+            return None
+    return indices
+
 def start_bulk_operation(query: str, variables: dict = None) -> str:
     '''Returns operation id. Raises for user errors.'''
     res = graphql_query(query, variables)
@@ -1,29 +1,181 @@
 import os
+import io
+import gzip
+import zlib
 import json
+import shutil
+import hashlib
+import tempfile
+from threading import Lock
+from typing import Any, BinaryIO, Iterable, Iterator
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import boto3
-from io import StringIO
+from io import StringIO, BytesIO
+from botocore.config import Config as BotoConfig
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
-from flask import current_app
-from typing import Any
+try:
+    import zstandard
+except ImportError: # optional, only needed for ARCHIVE_COMPRESSION = 'zstd'
+    zstandard = None
 
 class StorageNotFoundError(Exception):
     '''Raised when a requested file or object is not found in storage.'''
     pass
 
-class StorageService:    
-    def __init__(self):
-        self.use_local_storage = current_app.config.get('USE_LOCAL_STORAGE', False)
-        self.data_path = current_app.config['DATA_DIR']
+STREAM_CHUNK_SIZE = 1024 * 1024
+# file suffix and content type of each supported archive compression
+ARCHIVE_COMPRESSIONS = {
+    'gzip': ('.gz', 'application/gzip'),
+    'zstd': ('.zst', 'application/zstd'),
+    'none': ('', 'application/octet-stream'),
+}
+
+class IterStream(io.RawIOBase):
+    '''Read-only binary file-like object over an iterator of bytes or str chunks.'''
+    def __init__(self, chunks: Iterable[bytes | str]):
+        self._chunks = iter(chunks)
+        self._pending = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                return 0
+            self._pending = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+class DiskCache:
+    '''
+    Size-bounded LRU cache of remote objects on local disk.
+
+    Every entry is a '<hash>.bin' file with the object's ETag in its first line 
+    and the data after it, so that the ETag and the data are always replaced 
+    together. The mtime of the file is the entry's last access time: the least 
+    recently used entries are evicted once the cache grows over max_bytes.
+    Several processes can share the same directory.
+    '''
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.bin')
+
+    def get(self, key: str) -> tuple[bytes, str] | None:
+        '''Returns (data, etag) or None if the key is not cached.'''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                etag = f.readline().rstrip(b'\n').decode('utf-8', errors='replace')
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data, etag
+
+    def put(self, key: str, data: bytes, etag: str) -> None:
+        if len(data) > self.max_bytes:
+            self.invalidate(key)
+            return
+        with self._lock:
+            # write to a temporary file first so readers never see half an entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(etag.encode('utf-8') + b'\n')
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+            self._evict()
+
+    def invalidate(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.etag'):
+                # left by the previous format, which kept the ETag apart
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+            elif entry.name.endswith('.bin'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+class StorageService:
+    '''
+    Create one per app (see create_app) and reuse it: the S3 client is 
+    thread-safe and keeps a pool of connections open between calls.
+    '''
+    def __init__(self, app=None):
+        self.client = None
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.use_local_storage = app.config.get('USE_LOCAL_STORAGE', False)
+        self.data_path = app.config['DATA_DIR']
+        self.archive_compression = app.config['ARCHIVE_COMPRESSION']
+        if self.archive_compression not in ARCHIVE_COMPRESSIONS:
+            raise ValueError(f'Unknown ARCHIVE_COMPRESSION: {self.archive_compression}')
+        if self.archive_compression == 'zstd' and zstandard is None:
+            app.logger.warning("ARCHIVE_COMPRESSION is 'zstd' but the zstandard package "
+                               "is not installed. Using gzip.")
+            self.archive_compression = 'gzip'
 
         if not self.use_local_storage:
-            self.client = boto3.client(
+            self.client = boto3.session.Session().client(
                 's3',
-                aws_access_key_id=current_app.config['AWS_ACCESS_KEY'],
-                aws_secret_access_key=current_app.config['AWS_SECRET_KEY'],
-                region_name=current_app.config['AWS_REGION']
+                aws_access_key_id=app.config['AWS_ACCESS_KEY'],
+                aws_secret_access_key=app.config['AWS_SECRET_KEY'],
+                region_name=app.config['AWS_REGION'],
+                config=BotoConfig(
+                    max_pool_connections=app.config['STORAGE_MAX_POOL_CONNECTIONS'],
+                    retries={
+                        'max_attempts': app.config['STORAGE_MAX_ATTEMPTS'],
+                        'mode': 'standard'
+                    })
             )
-            self.bucket_name = current_app.config['AWS_BUCKET_NAME']
+            self.bucket_name = app.config['AWS_BUCKET_NAME']
+            # objects larger than the threshold are uploaded in parts, in parallel
+            self.transfer_config = TransferConfig(
+                multipart_threshold=app.config['STORAGE_MULTIPART_THRESHOLD'],
+                multipart_chunksize=app.config['STORAGE_MULTIPART_CHUNKSIZE'],
+                max_concurrency=app.config['STORAGE_MAX_POOL_CONNECTIONS'])
+
+            # S3 downloads are cached on local disk and revalidated with their ETag
+            if app.config['STORAGE_CACHE_MAX_BYTES'] > 0:
+                self.cache = DiskCache(app.config['STORAGE_CACHE_DIR'], 
+                                       app.config['STORAGE_CACHE_MAX_BYTES'])
 
     def _get_path_or_key(self, key: str) -> str:
         '''
@@ -34,34 +186,56 @@ class StorageService:
             key = key[1:]
         return os.path.join(self.data_path, key)
 
-    def upload_text(self, key: str, text: str) -> None:
-        '''Uploads plain text to storage.'''
-        key = self._get_path_or_key(key)
+    def _put_bytes(self, path_or_key: str, data: bytes) -> None:
+        '''Writes raw bytes to an already resolved local path or S3 key.'''
         if self.use_local_storage:
-            with open(key, 'w', encoding='utf-8') as f:
-                f.write(text)
+            os.makedirs(os.path.dirname(path_or_key), exist_ok=True)
+            with open(path_or_key, 'wb') as f:
+                f.write(data)
         else:
-            self.client.put_object(Bucket=self.bucket_name, Key=key, Body=text)
+            res = self.client.put_object(Bucket=self.bucket_name, Key=path_or_key, Body=data)
+            if self.cache:
+                self.cache.put(path_or_key, data, res['ETag'])
 
-    def download_text(self, key: str) -> str:
-        '''Downloads plain text from storage.'''
-        key = self._get_path_or_key(key)
-        
+    def _get_bytes(self, path_or_key: str) -> bytes:
+        '''Reads raw bytes from an already resolved local path or S3 key.'''
         if self.use_local_storage:
-            if not os.path.exists(key):
-                raise StorageNotFoundError(f"File not found: {key}")
-            with open(key, 'r', encoding='utf-8') as f:
+            if not os.path.exists(path_or_key):
+                raise StorageNotFoundError(f"File not found: {path_or_key}")
+            with open(path_or_key, 'rb') as f:
                 return f.read()
         
         else:
+            cached = self.cache.get(path_or_key) if self.cache else None
+            conditions = {'IfNoneMatch': cached[1]} if cached else {}
             try:
-                obj = self.client.get_object(Bucket=self.bucket_name, Key=key)
-                return obj['Body'].read().decode('utf-8')
+                obj = self.client.get_object(Bucket=self.bucket_name, Key=path_or_key, 
+                                             **conditions)
             except ClientError as e:
-                if e.response['Error']['Code'] == 'NoSuchKey':
-                    raise StorageNotFoundError(f"S3 object not found: {key}")
+                code = e.response['Error']['Code']
+                if cached and code in ('304', 'NotModified'):
+                    return cached[0]
+                if code == 'NoSuchKey':
+                    if self.cache:
+                        self.cache.invalidate(path_or_key)
+                    raise StorageNotFoundError(f"S3 object not found: {path_or_key}")
                 raise
 
+            data = obj['Body'].read()
+            if self.cache:
+                self.cache.put(path_or_key, data, obj['ETag'])
+            return data
+
+    def upload_text(self, key: str, text: str | bytes) -> None:
+        '''Uploads plain text to storage.'''
+        key = self._get_path_or_key(key)
+        self._put_bytes(key, text.encode('utf-8') if isinstance(text, str) else text)
+
+    def download_text(self, key: str) -> str:
+        '''Downloads plain text from storage.'''
+        key = self._get_path_or_key(key)
+        return self._get_bytes(key).decode('utf-8')
+
     # TODO change all processes that require file deletion so that this is no 
     # longer necessary, then remove this method and any delete privileges from 
     # the AWS permissions.
@@ -74,30 +248,183 @@ class StorageService:
                 os.remove(key)
         else:
             self.client.delete_object(Bucket=self.bucket_name, Key=key)
+            if self.cache:
+                self.cache.invalidate(key)
+
+    def exists(self, key: str) -> bool:
+        '''True if the file exists in storage.'''
+        key = self._get_path_or_key(key)
+        if self.use_local_storage:
+            return os.path.exists(key)
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
 
     def upload_json(self, key: str, data: Any) -> None:
         '''Uploads JSON data to storage.'''
-        key = self._get_path_or_key(key)
         self.upload_text(key, json.dumps(data, indent=4))
 
     def download_json(self, key: str) -> Any:
         '''Downloads JSON data from storage.'''
-        key = self._get_path_or_key(key)
         return json.loads(self.download_text(key))
 
     def upload_csv(self, key: str, df: pd.DataFrame, index:bool=False) -> None:
         '''Uploads a Pandas DataFrame as a CSV to storage.'''
-        key = self._get_path_or_key(key)
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=index)
-        self.upload_text(key, csv_buffer.getvalue())
+        # large CSVs spill to a temporary file instead of being kept in memory
+        with tempfile.SpooledTemporaryFile(max_size=STREAM_CHUNK_SIZE * 8) as f:
+            df.to_csv(f, index=index, encoding='utf-8')
+            f.seek(0)
+            self.upload_fileobj(key, f, content_type='text/csv')
 
     def download_csv(self, key: str) -> pd.DataFrame:
         '''Downloads a CSV from storage into a Pandas DataFrame.'''
-        key = self._get_path_or_key(key)
         csv_data = self.download_text(key)
         return pd.read_csv(StringIO(csv_data))
     
-    def upload_bytes(self, s3_key, data, content_type="application/octet-stream"):
-        '''Upload in-memory data to S3.'''
-        self.client.upload_fileobj(data, self.bucket_name, s3_key, ExtraArgs={"ContentType": content_type})
+    def upload_parquet(self, key: str, table: pa.Table) -> None:
+        '''Uploads an Arrow table as a Parquet file to storage.'''
+        key = self._get_path_or_key(key)
+        buffer = BytesIO()
+        pq.write_table(table, buffer)
+        self._put_bytes(key, buffer.getvalue())
+
+    def download_parquet(self, key: str) -> pa.Table:
+        '''Downloads a Parquet file from storage into an Arrow table.'''
+        key = self._get_path_or_key(key)
+        return pq.read_table(BytesIO(self._get_bytes(key)))
+    
+    def upload_bytes(self, key: str, data: bytes | BinaryIO, 
+                     content_type: str = "application/octet-stream") -> None:
+        '''Uploads bytes or a binary file-like object to storage.'''
+        if isinstance(data, (bytes, bytearray)):
+            data = BytesIO(data)
+        self.upload_fileobj(key, data, content_type=content_type)
+
+    def upload_fileobj(self, key: str, fileobj: BinaryIO, 
+                       content_type: str = "application/octet-stream") -> None:
+        '''
+        Streams a binary file-like object to storage without reading it all into 
+        memory. In S3, large objects are sent as a multipart upload.
+        '''
+        key = self._get_path_or_key(key)
+        if self.use_local_storage:
+            os.makedirs(os.path.dirname(key), exist_ok=True)
+            with open(key, 'wb') as f:
+                shutil.copyfileobj(fileobj, f, STREAM_CHUNK_SIZE)
+        else:
+            self.client.upload_fileobj(fileobj, self.bucket_name, key, 
+                                       ExtraArgs={"ContentType": content_type},
+                                       Config=self.transfer_config)
+            if self.cache:
+                self.cache.invalidate(key)
+
+    def upload_iter(self, key: str, chunks: Iterable[bytes | str], 
+                    content_type: str = "application/octet-stream") -> None:
+        '''
+        Streams chunks from an iterator (e.g. a generator of CSV lines) to 
+        storage. str chunks are encoded as utf-8.
+        '''
+        self.upload_fileobj(key, io.BufferedReader(IterStream(chunks), STREAM_CHUNK_SIZE),
+                            content_type=content_type)
+
+    def download_fileobj(self, key: str, fileobj: BinaryIO) -> None:
+        '''Streams a file from storage into a binary file-like object.'''
+        for chunk in self.iter_download(key):
+            fileobj.write(chunk)
+
+    def iter_download(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        '''Yields the contents of a file in storage in chunks of up to chunk_size bytes.'''
+        key = self._get_path_or_key(key)
+        if self.use_local_storage:
+            if not os.path.exists(key):
+                raise StorageNotFoundError(f"File not found: {key}")
+            with open(key, 'rb') as f:
+                while chunk := f.read(chunk_size):
+                    yield chunk
+        else:
+            try:
+                obj = self.client.get_object(Bucket=self.bucket_name, Key=key)
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'NoSuchKey':
+                    raise StorageNotFoundError(f"S3 object not found: {key}")
+                raise
+            yield from obj['Body'].iter_chunks(chunk_size)
+
+    def iter_lines(self, key: str) -> Iterator[str]:
+        '''Yields the lines of a utf-8 text file in storage, without line endings.'''
+        stream = io.BufferedReader(IterStream(self.iter_download(key)), STREAM_CHUNK_SIZE)
+        for line in io.TextIOWrapper(stream, encoding='utf-8'):
+            yield line.rstrip('\r\n')
+
+    def upload_archive(self, fileobj: BinaryIO, extension: str, 
+                       compression: str = None) -> tuple[str, str]:
+        '''
+        Compresses and stores a file under a key derived from the SHA-256 of its 
+        (uncompressed) content, e.g. 'archive/3f/3fa9...c1.csv.gz'. Identical 
+        files share the same key, so they are only uploaded once.
+
+        Params:
+        - fileobj: binary file-like object with the content to archive
+        - extension: file extension of the content, e.g. 'csv'
+        - compression: one of ARCHIVE_COMPRESSIONS. Defaults to ARCHIVE_COMPRESSION 
+        from the config.
+
+        Returns (key, content_hash). Use download_archive(key) to read it back.
+        '''
+        compression = compression or self.archive_compression
+        suffix, content_type = ARCHIVE_COMPRESSIONS[compression]
+        hasher = hashlib.sha256()
+
+        with tempfile.SpooledTemporaryFile(max_size=STREAM_CHUNK_SIZE * 8) as compressed:
+            if compression == 'gzip':
+                writer = gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0)
+            elif compression == 'zstd':
+                writer = zstandard.ZstdCompressor().stream_writer(compressed, closefd=False)
+            else:
+                writer = None
+
+            while chunk := fileobj.read(STREAM_CHUNK_SIZE):
+                hasher.update(chunk)
+                (writer or compressed).write(chunk)
+            if writer:
+                writer.close() # flushes, leaving `compressed` open
+
+            content_hash = hasher.hexdigest()
+            key = f'archive/{content_hash[:2]}/{content_hash}.{extension}{suffix}'
+            if not self.exists(key):
+                compressed.seek(0)
+                self.upload_fileobj(key, compressed, content_type=content_type)
+
+        return key, content_hash
+
+    def download_archive(self, key: str) -> bytes:
+        '''Downloads and decompresses a file stored with upload_archive().'''
+        data = self._get_bytes(self._get_path_or_key(key))
+        if key.endswith(ARCHIVE_COMPRESSIONS['gzip'][0]):
+            return gzip.decompress(data)
+        if key.endswith(ARCHIVE_COMPRESSIONS['zstd'][0]):
+            if zstandard is None:
+                raise RuntimeError(f'The zstandard package is needed to read {key}')
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        return data
+
+    def iter_archive(self, key: str) -> Iterator[bytes]:
+        '''Like download_archive(), decompressing one downloaded chunk at a time.'''
+        chunks = self.iter_download(key)
+        if key.endswith(ARCHIVE_COMPRESSIONS['gzip'][0]):
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16) # gzip header
+            for chunk in chunks:
+                if data := decompressor.decompress(chunk):
+                    yield data
+            if data := decompressor.flush():
+                yield data
+        elif key.endswith(ARCHIVE_COMPRESSIONS['zstd'][0]):
+            if zstandard is None:
+                raise RuntimeError(f'The zstandard package is needed to read {key}')
+            yield from zstandard.ZstdDecompressor().read_to_iter(IterStream(chunks))
+        else:
+            yield from chunks
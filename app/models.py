@@ -58,6 +58,9 @@ class User(UserMixin, db.Model):
         return db.session.get(User, uid)
 
 class AdminAction(db.Model):
+    # for a user's actions, newest first
+    __table_args__ = (sa.Index('ix_admin_action_user_id_timestamp', 'user_id', 'timestamp'),)
+
     id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
     timestamp: orm.Mapped[datetime] = orm.mapped_column(
         index= True, 
@@ -77,9 +80,15 @@ class AdminAction(db.Model):
 class File(db.Model):
     id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
     path: orm.Mapped[str] = orm.mapped_column(sa.String(256))
-    admin_action_id: orm.Mapped[int] = orm.mapped_column(
+    # files archived with StorageService.upload_archive() are stored under 
+    # storage_key (compressed, content-addressed) instead of under path
+    content_hash: orm.Mapped[Optional[str]] = orm.mapped_column(sa.String(64), 
+                                                               index=True)
+    storage_key: orm.Mapped[Optional[str]] = orm.mapped_column(sa.String(256))
+    # None for files archived outside an admin's action, e.g. bulk syncs and labels
+    admin_action_id: orm.Mapped[Optional[int]] = orm.mapped_column(
         sa.ForeignKey(AdminAction.id), index=True)
-    admin_action: orm.Mapped[AdminAction] = orm.relationship(back_populates='files')
+    admin_action: orm.Mapped[Optional[AdminAction]] = orm.relationship(back_populates='files')
 
     def __repr__(self):
         return '<File {}>'.format(self.path)
@@ -188,3 +197,50 @@ class Metadata(db.Model):
         else:
             metadata.value = handle
         db.session.commit()
+
+# Local copy of the Shopify catalog, rebuilt by every bulk sync (see 
+# bulk_processing.update_catalog) and searched by app/shop/catalog.py, so 
+# searches don't query Shopify. ids are the numeric part of Shopify's gids.
+class CatalogProduct(db.Model):
+    id: orm.Mapped[int] = orm.mapped_column(sa.BigInteger, primary_key=True,
+                                            autoincrement=False)
+    title: orm.Mapped[str] = orm.mapped_column(sa.String(256), index=True)
+    vendor: orm.Mapped[str] = orm.mapped_column(sa.String(256), index=True)
+    pueblo: orm.Mapped[Optional[str]] = orm.mapped_column(sa.String(128), index=True)
+    estado: orm.Mapped[Optional[str]] = orm.mapped_column(sa.String(128), index=True)
+    # simple_lower_ascii() of vendor, pueblo and estado, which are filtered by
+    # without case or accents
+    vendor_key: orm.Mapped[str] = orm.mapped_column(sa.String(256), index=True)
+    pueblo_key: orm.Mapped[Optional[str]] = orm.mapped_column(sa.String(128), index=True)
+    estado_key: orm.Mapped[Optional[str]] = orm.mapped_column(sa.String(128), index=True)
+    variants: orm.Mapped[list['CatalogVariant']] = orm.relationship(
+        back_populates='product', order_by='CatalogVariant.id')
+
+    def __repr__(self):
+        return f'<CatalogProduct {self.id}: {self.title}>'
+
+class CatalogVariant(db.Model):
+    id: orm.Mapped[int] = orm.mapped_column(sa.BigInteger, primary_key=True,
+                                            autoincrement=False)
+    product_id: orm.Mapped[int] = orm.mapped_column(sa.ForeignKey(CatalogProduct.id),
+                                                    index=True)
+    # Shopify allows SKUs of up to 255 characters
+    sku: orm.Mapped[Optional[str]] = orm.mapped_column(sa.String(256), index=True)
+    title: orm.Mapped[Optional[str]] = orm.mapped_column(sa.String(256))
+    price: orm.Mapped[Optional[str]] = orm.mapped_column(sa.String(32))
+    product: orm.Mapped[CatalogProduct] = orm.relationship(back_populates='variants')
+
+    def __repr__(self):
+        return f'<CatalogVariant {self.sku}>'
+
+class CatalogToken(db.Model):
+    '''
+    Inverted index of the catalog: one row per word (lowered, without accents)
+    of a product's title, vendor, pueblo, estado and SKUs.
+    '''
+    token: orm.Mapped[str] = orm.mapped_column(sa.String(64), primary_key=True)
+    product_id: orm.Mapped[int] = orm.mapped_column(sa.ForeignKey(CatalogProduct.id),
+                                                    primary_key=True, index=True)
+
+    def __repr__(self):
+        return f'<CatalogToken {self.token}: {self.product_id}>'
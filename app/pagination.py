@@ -0,0 +1,127 @@
+import json
+import base64
+import binascii
+from datetime import datetime
+import sqlalchemy as sa
+from app import db
+
+class KeysetPage:
+    '''
+    One page of results of keyset_paginate():
+    - items: the rows of this page
+    - start: position of the first item in the whole list, starting at 1
+    - next_cursor/prev_cursor: pass them as `after`/`before` to
+    keyset_paginate() to get the next/previous page. None if there is none.
+    '''
+    def __init__(self, items: list, start: int, next_cursor: str | None,
+                 prev_cursor: str | None):
+        self.items = items
+        self.start = start
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self) -> bool:
+        return self.prev_cursor is not None
+
+def keyset_paginate(query: sa.Select, keys: list[tuple], per_page: int,
+                    after: str = None, before: str = None) -> KeysetPage:
+    '''
+    Paginates query by seeking to the sort keys of the last row shown instead
+    of using OFFSET, so a page costs the same however far it is from the first
+    one, and no COUNT query is made. Use an index that matches keys.
+
+    Params:
+    - query: a select() of one entity, without order_by.
+    - keys: (expression, descending) pairs to sort by. The expressions can't be
+    NULL (use coalesce) and the last one must be unique, e.g. the primary key.
+    - after/before: cursor of the page to get (KeysetPage.next_cursor or
+    prev_cursor). Without them, or if they are invalid, returns the first page.
+
+    e.g. `keyset_paginate(sa.select(Vendor), [(Vendor.name, False), (Vendor.id, False)], 50)`
+    '''
+    backwards = bool(before)
+    cursor = _decode_cursor(before if backwards else after, keys)
+    backwards = backwards and cursor is not None
+    # walking backwards, rows are fetched in reverse order and flipped afterwards
+    directions = [descending != backwards for _, descending in keys]
+    expressions = [expression for expression, _ in keys]
+
+    query = query.add_columns(*expressions)
+    if cursor is not None:
+        query = query.where(_seek(expressions, directions, cursor['values']))
+    query = query.order_by(*[e.desc() if desc else e.asc()
+                             for e, desc in zip(expressions, directions)])
+    rows = db.session.execute(query.limit(per_page + 1)).all()
+
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    items = [row[0] for row in rows]
+
+    if cursor is None:
+        start = 1
+    elif backwards:
+        start = max(cursor['position'] - len(rows), 1)
+    else:
+        start = cursor['position']
+
+    first = _encode_cursor(rows[0][1:], start) if rows else None
+    last = _encode_cursor(rows[-1][1:], start + len(rows)) if rows else None
+    if backwards:
+        return KeysetPage(items, start, next_cursor=last, prev_cursor=first if more else None)
+    return KeysetPage(items, start, next_cursor=last if more else None,
+                      prev_cursor=first if cursor is not None else None)
+
+def _seek(expressions: list, directions: list[bool], values: list):
+    '''Condition for the rows that come after values in the given order.'''
+    # bound with the expressions' types (SQLAlchemy won't compare True/False with <, >)
+    values = [sa.literal(v, e.type) for e, v in zip(expressions, values)]
+    clauses = []
+    for i, (expression, descending) in enumerate(zip(expressions, directions)):
+        equal = [e == v for e, v in zip(expressions[:i], values[:i])]
+        beyond = expression < values[i] if descending else expression > values[i]
+        clauses.append(sa.and_(*equal, beyond))
+    # redundant with the clauses, but lets the db use an index range on the first key
+    first = expressions[0] <= values[0] if directions[0] else expressions[0] >= values[0]
+    return sa.and_(first, sa.or_(*clauses))
+
+def _encode_cursor(values, position: int) -> str:
+    '''position numbers the first row after the cursor, so pages keep counting.'''
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    data = json.dumps({'values': values, 'position': position}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor: str | None, keys: list[tuple]) -> dict | None:
+    if not cursor:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        values = data['values']
+        if len(values) != len(keys):
+            return None
+        for i, (expression, _) in enumerate(keys):
+            if expression.type.python_type is datetime:
+                values[i] = datetime.fromisoformat(values[i])
+        return {'values': values, 'position': int(data['position'])}
+    except (ValueError, KeyError, TypeError, UnicodeError, binascii.Error, NotImplementedError):
+        return None
+
+def estimate_count(model) -> int:
+    '''
+    Number of rows in a model's table. On PostgreSQL it's the planner's
+    estimate, which is read without scanning the table; elsewhere an exact
+    COUNT.
+    '''
+    if db.engine.dialect.name == 'postgresql':
+        estimate = db.session.scalar(
+            sa.text('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)'),
+            {'table': model.__tablename__})
+        if estimate is not None and estimate >= 0: # -1 if never analyzed
+            return estimate
+    return db.session.scalar(sa.select(sa.func.count()).select_from(model))
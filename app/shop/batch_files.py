@@ -0,0 +1,104 @@
+import io
+import re
+import csv
+import os
+import zipfile
+from datetime import date, datetime
+from typing import BinaryIO, Iterator
+import pandas as pd
+from gspread.utils import numericise
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+from app.utils import simple_lower_ascii, get_datestring
+from app.integrations.sheety import SHEET_SCHEMAS, apply_schema
+
+class BatchFileError(Exception):
+    '''The file can't be read as a batch (wrong extension, no header row...).'''
+
+def iter_batch_file(fileobj: BinaryIO, filename: str) -> Iterator[dict]:
+    '''
+    Yields the rows of a CSV file or of the first worksheet of an XLSX file as
+    dicts where keys are column headers (first row), one row at a time.
+
+    Values are typed like the records of gsheets.get_sheet_data(): numbers are
+    ints/floats, dates are 'yyyy-mm-dd' strings and empty cells are ''. Empty
+    rows and columns without header are skipped.
+    '''
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    if extension == 'csv':
+        # utf-8-sig drops the BOM that Excel adds to CSV exports
+        text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+        rows = csv.reader(text)
+        close = text.detach # leaves fileobj open, like load_workbook does
+    elif extension == 'xlsx':
+        try:
+            workbook = load_workbook(fileobj, read_only=True, data_only=True)
+        except (zipfile.BadZipFile, InvalidFileException, KeyError) as e:
+            raise BatchFileError(f'{filename} is not a valid XLSX file: {e}') from e
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        close = workbook.close
+    else:
+        raise BatchFileError(f'Unsupported file type: {filename}')
+
+    try:
+        headers = next(rows, None)
+        if not headers or not any(headers):
+            raise BatchFileError(f'{filename} has no header row.')
+        headers = [str(h).strip() if h is not None else '' for h in headers]
+
+        for row in rows:
+            values = [_cell_value(value) for value in row]
+            if all(value == '' for value in values):
+                continue
+            yield {header: value for header, value in zip(headers, values) if header}
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise BatchFileError(f'{filename} is not a valid UTF-8 CSV file: {e}') from e
+    finally:
+        close()
+
+def _cell_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime, date)):
+        return get_datestring(value)
+    if isinstance(value, str):
+        return numericise(value.strip())
+    return value
+
+def read_batch_file(fileobj: BinaryIO, filename: str, include_row_num=False) -> list[dict]:
+    '''
+    Returns the rows of a CSV/XLSX file (see iter_batch_file). With
+    include_row_num, each row gets a 'Row Number' like gsheets.get_sheet_data().
+    '''
+    data = []
+    for i, row in enumerate(iter_batch_file(fileobj, filename), start=1):
+        if include_row_num:
+            row['Row Number'] = str(i)
+        data.append(row)
+    return data
+
+def normalize_header(header: str) -> str:
+    '''e.g. "Cantidad a agregar", "cantidadAAgregar" and "CANTIDAD A AGREGAR" all give "cantidadaagregar".'''
+    return re.sub(r'[^a-z0-9]', '', simple_lower_ascii(header))
+
+def rename_to(df: pd.DataFrame, columns: dict) -> pd.DataFrame:
+    '''
+    Renames df columns with a {header: new name} mapping, matching headers
+    regardless of capitalization, accents, spaces and punctuation.
+    '''
+    normalized = {normalize_header(header): name for header, name in columns.items()}
+    return df.rename(columns=lambda col: normalized.get(normalize_header(col), col))
+
+def inventory_updates_from_file(fileobj: BinaryIO, filename: str) -> pd.DataFrame:
+    '''
+    Reads an 'Actualizar Cantidades' batch from a CSV/XLSX file into the same
+    columns and dtypes as sheety.fetch_inventory_updates(), ready for
+    complete_sheety_data().
+    '''
+    schema = SHEET_SCHEMAS[('actualizarCantidades', 'cantidades')]
+    df = pd.DataFrame(read_batch_file(fileobj, filename))
+    df = rename_to(df, {column: column for column in schema})
+    if 'id' not in df:
+        # Sheety's ids are sheet rows, and row 1 is the header
+        df['id'] = range(2, len(df) + 2)
+    return apply_schema(df, schema)
@@ -5,16 +5,20 @@ import json
 import ast
 import pandas as pd
 import time
+import tempfile
 from collections import defaultdict
+from datetime import datetime, timezone
 from threading import Thread
 import requests
 from flask import current_app
 import sqlalchemy as sa
 from app import storage_service, db
-from app.models import Vendor, State, Town, ShopifyVendor
+from app.models import Vendor, State, Town, ShopifyVendor, CatalogProduct, \
+    CatalogVariant, CatalogToken, File
 from app.utils import simple_lower_ascii
 from app.integrations.shopify import start_bulk_operation, poll_bulk_operation
 from app.shop.graphql_queries import bulk_op_products
+from app.shop.catalog import product_tokens, facet_key
 
 def async_update_db():
     '''
@@ -22,35 +26,54 @@ def async_update_db():
     update the vendors table.
     '''
     id = start_bulk_operation(bulk_op_products)
+    app = current_app._get_current_object()
 
     def poll():
-        while True:
-            time.sleep(5)
-            url = poll_bulk_operation(id)
-            if url:
-                break
-
-        file_path = "jsonl/products.jsonl"
-        file_content = requests.get(url).content
-
-        current_app.logger.info("File downloaded. Processing...")
-        data = [json.loads(line) for line in file_content.splitlines()]
-        
-        update_database(data)
-
-        current_app.logger.info('Uploading jsonl to S3')
-        storage = storage_service()
-        storage.upload_text(file_path, file_content) 
-        # TODO every time a file is uploaded, create a record in the File table
+        with app.app_context():
+            while True:
+                time.sleep(5)
+                url = poll_bulk_operation(id)
+                if url:
+                    break
+
+            # the export can be large: it is streamed to a temporary file (kept 
+            # in memory only while small) and uploaded from there
+            with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as file_content:
+                with requests.get(url, stream=True, timeout=(5, 60)) as res:
+                    res.raise_for_status()
+                    for chunk in res.iter_content(chunk_size=1024 * 1024):
+                        file_content.write(chunk)
+
+                current_app.logger.info("File downloaded. Processing...")
+                file_content.seek(0)
+                data = [json.loads(line) for line in file_content if line.strip()]
+                
+                update_database(data)
+
+                current_app.logger.info('Archiving jsonl')
+                file_content.seek(0)
+                storage = storage_service()
+                key, content_hash = storage.upload_archive(file_content, 'jsonl')
+                current_app.logger.info(f'Products archived as {key}')
+                timestamp = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')
+                db.session.add(File(path=f'shopify/bulk_products_{timestamp}.jsonl', 
+                                    content_hash=content_hash, storage_key=key))
+                db.session.commit()
 
     thread = Thread(target=poll, daemon=True,)
     thread.start()
 
 def read_jsonl(data_path: str) -> list[dict]:
-    '''Reads JSONL data from storage service.'''
+    '''
+    Reads JSONL data from storage service. data_path can also be the key of a 
+    file stored with upload_archive(), e.g. a bulk sync.
+    '''
     storage = storage_service()
-    data = storage.download_text(data_path)
-    return [json.loads(line) for line in data.splitlines()]
+    if data_path.startswith('archive/'):
+        lines = storage.download_archive(data_path).decode('utf-8').splitlines()
+    else:
+        lines = storage.iter_lines(data_path)
+    return [json.loads(line) for line in lines if line]
 
 def products_df(data: list[dict]) -> pd.DataFrame:
     '''
@@ -160,12 +183,79 @@ def locations_df(data: list[dict]) -> pd.DataFrame:
     return df
 
 def update_database(data: list[dict]):
-    '''Updates vendor, pueblo, estado tables.'''
+    '''Updates the product catalog and the vendor, pueblo, estado tables.'''
+    # the catalog is only used to search products: if it can't be rebuilt the
+    # previous one is kept, and the other tables are still updated
+    try:
+        update_catalog(data)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f'Could not update the product catalog: {e}')
     locations = locations_df(data)
     update_locations(locations)
     vendors = vendors_df(data)
     update_vendors(vendors)
 
+def _fit(value: str | None, column) -> str | None:
+    '''value cut to the length of a String column, so long values can be stored.'''
+    return value[:column.type.length] if value else value
+
+def shopify_id(gid: str) -> int:
+    '''e.g. shopify_id('gid://shopify/Product/123') -> 123'''
+    return int(gid.rsplit('/', 1)[-1])
+
+def update_catalog(data: list[dict], chunk_size: int = 1000):
+    '''
+    Replaces the local product catalog (CatalogProduct, CatalogVariant and 
+    their CatalogToken search index) with the products in data, in one 
+    transaction.
+    '''
+    current_app.logger.info('Updating product catalog...')
+    products, variants, skus = {}, [], defaultdict(list)
+
+    for row in data:
+        if 'vendor' in row:  # Product entry
+            products[row['id']] = {
+                'id': shopify_id(row['id']),
+                'title': _fit(row['title'], CatalogProduct.title),
+                'vendor': _fit(row['vendor'], CatalogProduct.vendor),
+                'pueblo': None,
+                'estado': None,
+            }
+        elif 'namespace' in row and row['__parentId'] in products:  # product metafield
+            if row['namespace'] == 'custom' and row['key'] in ('pueblo', 'estado'):
+                column = getattr(CatalogProduct, row['key'])
+                products[row['__parentId']][row['key']] = _fit(row['value'], column) or None
+        elif 'sku' in row and row['__parentId'] in products: # product variant
+            variants.append({
+                'id': shopify_id(row['id']),
+                'product_id': shopify_id(row['__parentId']),
+                'sku': _fit(row['sku'], CatalogVariant.sku) or None,
+                'title': _fit(row.get('title'), CatalogVariant.title),
+                'price': _fit(row.get('price'), CatalogVariant.price),
+            })
+            if row['sku']:
+                skus[row['__parentId']].append(row['sku'])
+
+    for product in products.values():
+        for name in ('vendor', 'pueblo', 'estado'):
+            key_column = getattr(CatalogProduct, f'{name}_key')
+            product[f'{name}_key'] = _fit(facet_key(product[name]), key_column)
+
+    tokens = [{'token': token, 'product_id': product['id']}
+              for gid, product in products.items()
+              for token in product_tokens(product, skus[gid])]
+
+    db.session.execute(sa.delete(CatalogToken))
+    db.session.execute(sa.delete(CatalogVariant))
+    db.session.execute(sa.delete(CatalogProduct))
+    for model, rows in ((CatalogProduct, list(products.values())), 
+                        (CatalogVariant, variants), (CatalogToken, tokens)):
+        for i in range(0, len(rows), chunk_size):
+            db.session.execute(sa.insert(model), rows[i:i + chunk_size])
+    db.session.commit()
+    current_app.logger.info(f'Catalog updated: {len(products)} products, {len(variants)} variants.')
+
 def update_locations(locations: pd.DataFrame):
     current_app.logger.info('Updating locations...')
 
@@ -1,17 +1,34 @@
 import json
 from datetime import datetime, timedelta
+from typing import BinaryIO
 import pandas as pd
 from flask import current_app
 import sqlalchemy as sa
-from app import db
+from app import db, storage_service
 from app.models import Vendor, Metadata
 from app.utils import simple_lower_ascii, extra_strip, validate_spanish_characters, remove_whitespace, get_datestring
 from app.integrations.shopify import graphql_query, raise_for_user_errors
 from app.shop.graphql_queries import product_set as product_set_mutation
 from app.shop.inventory import sku_available
 from app.integrations.gsheets import get_sheet_as_dataframe
+from app.integrations.storage import StorageNotFoundError
+from app.shop.batch_files import read_batch_file, rename_to
 from app.shop.utils import get_estado, get_pueblo
 
+# Captura worksheet headers and their standardized column names
+CAPTURA_COLUMNS = {
+    'Proveedor': 'vendor',
+    'Título': 'title',
+    'Clave': 'sku',
+    'Costo por unidad': 'cost',
+    'Precio Venta': 'price',
+    'Fecha Compra': 'dateOfPurchase',
+    'Cantidad': 'quantityDelta', #TODO: add who tagged the products. Can be managed in the app
+    'Row Number': 'rowNum'
+}
+# Captura loaded from a file (see stage_captura), used instead of the worksheet
+staged_captura_path = 'captura/staged_captura.json'
+
 def get_captura() -> pd.DataFrame:
     '''Returns Captura worksheet with standardized column names'''
     # Get with gsheets connector
@@ -19,20 +36,38 @@ def get_captura() -> pd.DataFrame:
     df = get_sheet_as_dataframe(captura_id, 'Captura', include_row_num=True)
 
     # rename cols
-    df.rename(inplace=True, columns=
-        {
-            'Proveedor': 'vendor',
-            'Título': 'title',
-            'Clave': 'sku',
-            'Costo por unidad': 'cost',
-            'Precio Venta': 'price',
-            'Fecha Compra': 'dateOfPurchase',
-            'Cantidad': 'quantityDelta', #TODO: add who tagged the products. Can be managed in the app
-            'Row Number': 'rowNum'
-        })
+    df.rename(inplace=True, columns=CAPTURA_COLUMNS)
     
     return df
 
+def stage_captura(fileobj: BinaryIO, filename: str) -> int:
+    '''
+    Reads a CSV/XLSX file with the Captura worksheet's columns and stores its
+    rows so that get_staged_captura() returns them until 
+    delete_staged_captura() is called. Returns the number of products.
+    '''
+    records = read_batch_file(fileobj, filename, include_row_num=True)
+    storage_service().upload_json(staged_captura_path, {
+        'filename': filename,
+        'records': records,
+    })
+    return len(records)
+
+def get_staged_captura() -> tuple[pd.DataFrame, str] | tuple[None, None]:
+    '''
+    Returns the captura stored by stage_captura(), with the same columns as 
+    get_captura(), and the name of its file. (None, None) if there is none.
+    '''
+    try:
+        staged = storage_service().download_json(staged_captura_path)
+    except StorageNotFoundError:
+        return None, None
+    df = rename_to(pd.DataFrame(staged['records']), CAPTURA_COLUMNS)
+    return df, staged['filename']
+
+def delete_staged_captura() -> None:
+    storage_service().delete(staged_captura_path)
+
 def captura_cleanup_and_validation(captura: pd.DataFrame) -> pd.DataFrame:
     '''
     Returns a cleaned up version of the dataframe with an additional columns 'errors' 
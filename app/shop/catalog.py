@@ -0,0 +1,102 @@
+# Search of the local product catalog (CatalogProduct, filled by the bulk sync
+# in bulk_processing.update_catalog)
+
+import re
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+from app import db
+from app.models import CatalogProduct, CatalogToken
+from app.utils import simple_lower_ascii
+
+TOKEN_LENGTH = 64
+# columns that can be used as filters and have facet counts
+FACETS = {
+    'vendor': CatalogProduct.vendor,
+    'pueblo': CatalogProduct.pueblo,
+    'estado': CatalogProduct.estado,
+}
+# their simple_lower_ascii() copies, which filters are compared with
+FACET_KEYS = {
+    'vendor': CatalogProduct.vendor_key,
+    'pueblo': CatalogProduct.pueblo_key,
+    'estado': CatalogProduct.estado_key,
+}
+
+def facet_key(value: str | None) -> str | None:
+    '''The value stored in FACET_KEYS columns, e.g. 'Michoacán ' -> 'michoacan'.'''
+    return simple_lower_ascii(value) if value else None
+
+def tokenize(text: str | None) -> list[str]:
+    '''
+    Words of text, lowered and without accents, e.g.
+    tokenize('Jarrón de Barro-Negro') -> ['jarron', 'de', 'barro', 'negro']
+    '''
+    if not text:
+        return []
+    return [token[:TOKEN_LENGTH] for token in re.findall(r'[a-z0-9]+', simple_lower_ascii(text))]
+
+def product_tokens(product: dict, skus: list[str]) -> set[str]:
+    '''Tokens of a product's title, vendor, pueblo, estado and SKUs.'''
+    tokens = set()
+    for field in ('title', 'vendor', 'pueblo', 'estado'):
+        tokens.update(tokenize(product.get(field)))
+    for sku in skus:
+        tokens.update(tokenize(sku))
+        # 'ABC-12' is also found as 'abc12'
+        tokens.add(''.join(tokenize(sku))[:TOKEN_LENGTH])
+    tokens.discard('')
+    return tokens
+
+def search_conditions(text: str = None, filters: dict = None) -> list:
+    '''
+    WHERE conditions for the products that have every word of text as the
+    start of one of their tokens and whose FACETS columns equal filters, 
+    ignoring case and accents.
+    '''
+    conditions = []
+    for token in dict.fromkeys(tokenize(text)):
+        # a range instead of LIKE so the token primary key is used whatever
+        # the collation: tokens only have [a-z0-9], so every token starting
+        # with token sorts between it and token + 'zzz...'
+        matches = sa.select(CatalogToken.product_id).where(
+            CatalogToken.token >= token,
+            CatalogToken.token <= token + 'z' * (TOKEN_LENGTH - len(token)))
+        conditions.append(CatalogProduct.id.in_(matches))
+    for name, value in (filters or {}).items():
+        if name in FACET_KEYS and value:
+            conditions.append(FACET_KEYS[name] == facet_key(value))
+    return conditions
+
+def search_query(text: str = None, filters: dict = None) -> sa.Select:
+    '''select() of matching products, with their variants, for keyset_paginate().'''
+    return sa.select(CatalogProduct) \
+        .where(*search_conditions(text, filters)) \
+        .options(orm.selectinload(CatalogProduct.variants))
+
+def facet_counts(text: str = None, filters: dict = None, limit: int = 20) -> dict:
+    '''
+    {facet: [(value, number of matching products), ...]} for each of FACETS,
+    the most common values first. Values that only differ in case or accents 
+    are counted together, under one of their spellings.
+    '''
+    conditions = search_conditions(text, filters)
+    facets = {}
+    for name, column in FACETS.items():
+        key = FACET_KEYS[name]
+        count = sa.func.count(CatalogProduct.id)
+        query = sa.select(sa.func.min(column), count).where(*conditions, key.is_not(None)) \
+            .group_by(key).order_by(count.desc(), key).limit(limit)
+        facets[name] = [tuple(row) for row in db.session.execute(query)]
+    return facets
+
+def spelled_as_facets(filters: dict, facets: dict) -> dict:
+    '''
+    filters with each value replaced by its spelling in facets (as returned by 
+    facet_counts(text, filters)), e.g. {'estado': 'oaxaca'} -> {'estado': 'Oaxaca'}
+    '''
+    spelled = {}
+    for name, value in filters.items():
+        matches = [facet_value for facet_value, _ in facets.get(name, []) 
+                   if facet_key(facet_value) == facet_key(value)]
+        spelled[name] = matches[0] if matches else value
+    return spelled
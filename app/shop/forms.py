@@ -1,11 +1,23 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import StringField, SubmitField
 
 class SubmitForm(FlaskForm):
     submit = SubmitField('Enviar')
 
+class BatchFileForm(FlaskForm):
+    file = FileField('Archivo CSV o XLSX', validators=[
+        FileRequired(), FileAllowed(['csv', 'xlsx'], 'Solo se aceptan archivos CSV o XLSX.')])
+    submit = SubmitField('Cargar archivo')
+
 class QueryProductsForm(FlaskForm):
     state = StringField('Estado')
     town = StringField('Pueblo/Ciudad')
     vendor = StringField('Artesano/Proveedor')
     submit = SubmitField('Buscar')
+
+class CatalogSearchForm(FlaskForm):
+    class Meta:
+        csrf = False # sent by GET, so results can be linked and paginated
+    q = StringField('Buscar por título, SKU, artesano, pueblo o estado')
+    submit = SubmitField('Buscar')
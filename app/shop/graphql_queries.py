@@ -54,9 +54,10 @@ get_variant_id_by_sku=\
 
 get_variants_from_products_query=\
 '''
-query GetVariantsFromProductsQuery {
-  products(first: 50, query:"%s") {
+query GetVariantsFromProductsQuery($query: String!, $locationId: ID!, $first: Int!, $after: String) {
+  products(first: $first, after: $after, query: $query) {
     nodes {
+      id
       vendor
       title
       metafields (first:2, keys:["custom.estado","custom.pueblo"]) {
@@ -75,7 +76,7 @@ query GetVariantsFromProductsQuery {
             unitCost {
               amount
             }
-            inventoryLevel(locationId: "gid://shopify/Location/101430165822") {
+            inventoryLevel(locationId: $locationId) {
               quantities (names: ["available"]) {
                 quantity
               }
@@ -99,6 +100,39 @@ query GetVariantsFromProductsQuery {
 }
 '''
 
+get_product_variants_query=\
+'''
+query GetProductVariants($id: ID!, $locationId: ID!, $first: Int!, $after: String) {
+  product(id: $id) {
+    variants(first: $first, after: $after) {
+      nodes {
+        title
+        price
+        sku
+        inventoryItem {
+          id
+          unitCost {
+            amount
+          }
+          inventoryLevel(locationId: $locationId) {
+            quantities (names: ["available"]) {
+              quantity
+            }
+          }
+        }
+        metafield (namespace: "custom", key: "cost_history") {
+          jsonValue
+        }
+      }
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+    }
+  }
+}
+'''
+
 set_variant_cost=\
 '''
 mutation inventoryItemUpdate($id: ID!, $input: InventoryItemInput!) {
@@ -228,6 +262,8 @@ mutation {
                   node {
                     id
                     sku
+                    title
+                    price
                     metafield (namespace: "custom", key: "cost_history") {
                       key
                       value
@@ -1,67 +1,145 @@
 import os
 import re
 import json
-from typing import Union
+from typing import Union, Iterator
+from itertools import chain
 from datetime import datetime, timezone, timedelta
 import pandas as pd
+import pyarrow as pa
 from numpy import nan
 from flask import current_app
 from app import storage_service
 from app.integrations.storage import StorageNotFoundError
 import app.shop.graphql_queries as q
-from app.integrations.shopify import graphql_query, raise_for_user_errors
+import app.shop.variant_cache as variant_cache
+from app.integrations.shopify import graphql_query, raise_for_user_errors, \
+    run_mutation_batches, user_error_indices, iter_connection
 
-quantities_path = 'quantities/quantities.csv'
+quantities_path = 'quantities/quantities.parquet'
 timestamp_path  = 'quantities/timestamp'
 
+cost_history_entry_type = pa.struct([
+    ('costo', pa.float64()),
+    ('cantidad', pa.int64()),
+    ('fecha de compra', pa.string()),
+])
+cost_history_type = pa.struct([
+    ('key', pa.string()),
+    ('namespace', pa.string()),
+    ('ownerId', pa.string()),
+    ('type', pa.string()),
+    ('compareDigest', pa.string()),
+    ('value', pa.list_(cost_history_entry_type)),
+])
+quantities_schema = pa.schema([
+    ('sku', pa.string()),
+    ('quantity', pa.int64()),
+    ('displayName', pa.string()),
+    ('vendor', pa.string()),
+    ('newPrice', pa.float64()),
+    ('priceDelta', pa.float64()),
+    ('newCost', pa.float64()),
+    ('costDelta', pa.float64()),
+    ('errors', pa.string()),
+    ('variantId', pa.string()),
+    ('productId', pa.string()),
+    ('inventoryItemId', pa.string()),
+    ('costHistory', cost_history_type),
+])
+# read numeric columns into nullable pandas dtypes instead of float64 with NaN
+quantities_dtypes = {
+    pa.int64(): pd.Int64Dtype(),
+    pa.float64(): pd.Float64Dtype(),
+    pa.string(): pd.StringDtype(),
+}
+
 def get_local_inventory() -> tuple[pd.DataFrame, str, int]:
     """
     Returns a tuple with: 
-    - the records stored in '<data_dir>update_quantities/quantities.csv'
-    - the time represented by the timestamp stored in '<data_dir>/update_quantities/timestamp'
+    - the records stored in '<data_dir>/quantities/quantities.parquet'. The 
+    'costHistory' column holds the metafield as a dict, ready to be sent to 
+    set_metafields().
+    - the time represented by the timestamp stored in '<data_dir>/quantities/timestamp'
     - the number of errors
     
     Both are None if files missing.
     """
     storage = storage_service()
     try:
-        data = storage.download_csv(quantities_path)
+        table = storage.download_parquet(quantities_path)
         saved_time = float(storage.download_text(timestamp_path))
         time = datetime.fromtimestamp(saved_time, tz=timezone.utc)
-        total_errors = data.loc[data['errors'] != 'none', 'errors'].count()
         
     except StorageNotFoundError:
-        data = None
-        time = None
-        total_errors = 0
+        return None, None, 0
+
+    data = table.drop_columns(['costHistory']).to_pandas(types_mapper=quantities_dtypes.get)
+    # to_pylist keeps nested lists as python lists (to_pandas makes them numpy arrays)
+    data['costHistory'] = table.column('costHistory').to_pylist()
+    total_errors = data.loc[data['errors'] != 'none', 'errors'].count()
 
     return data, time, total_errors
 
+def inventory_records(df: pd.DataFrame) -> list[dict]:
+    """Rows of the local inventory as dicts, with missing values as None."""
+    return df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
 def delete_local_inventory():
     storage = storage_service()
     storage.delete(quantities_path)
     storage.delete(timestamp_path)
 
 def write_local_inventory(df: pd.DataFrame):
+    df = df.reindex(columns=quantities_schema.names)
+    # built apart: error rows have no cost history, and a column without any 
+    # (all NaN) can't be converted to the struct type by from_pandas
+    cost_histories = pa.array(
+        [value if isinstance(value, dict) else None for value in df['costHistory']],
+        type=cost_history_type)
+    schema = quantities_schema.remove(quantities_schema.get_field_index('costHistory'))
+    table = pa.Table.from_pandas(df.drop(columns=['costHistory']), 
+                                 schema=schema, preserve_index=False)
+    table = table.append_column(quantities_schema.field('costHistory'), cost_histories)
     storage = storage_service()
-    storage.upload_csv(quantities_path, df)
+    storage.upload_parquet(quantities_path, table)
     now = datetime.now(timezone.utc)
     storage.upload_text(timestamp_path, str(now.timestamp()))
 
+def cost_history_entry(costo, cantidad, fecha_de_compra) -> dict:
+    """
+    A cost history item with the types of cost_history_entry_type. Values that 
+    are missing or can't be converted are set to None.
+    """
+    def convert(value, to_type):
+        try:
+            return None if pd.isna(value) else to_type(value)
+        except (TypeError, ValueError):
+            current_app.logger.warning(f'Invalid cost history value: {value}')
+            return None
+    
+    return {
+        "costo": convert(costo, float),
+        "cantidad": convert(cantidad, int),
+        "fecha de compra": convert(fecha_de_compra, str),
+    }
+
 def complete_sheety_data(sheety_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    sheety_df comes from fetch_inventory_updates(), so it has every column of 
+    the 'cantidades' schema in sheety.SHEET_SCHEMAS.
+    """
     # csv cols: sku, qty, display_name, vendor, new_price, price_delta, new_cost, cost_delta
     combined_data = []
     for index, row in sheety_df.iterrows():
-        sku = row.get('clave (sku)',            nan)
-        if not sku or sku != sku: continue
-        new_price = row.get('nuevoPrecioVenta', nan) # TODO: remove these 4 `nan` and instead make sure the sheety module returns all columns
-        new_cost = row.get('nuevoPrecioCompra', nan)
-        qty = row.get('cantidadAAgregar', nan)
-        if qty == qty:
-            qty = int(qty)
-        fecha_de_compra = row.get('fechaDeCompra (yyyyMmDd)', nan)
-        if fecha_de_compra != fecha_de_compra: #if fecha de compra is nan
+        sku = row['clave (sku)']
+        if pd.isna(sku) or not sku: continue
+        new_price = row['nuevoPrecioVenta']
+        new_cost = row['nuevoPrecioCompra']
+        qty = None if pd.isna(row['cantidadAAgregar']) else int(row['cantidadAAgregar'])
+        fecha_de_compra = row['fechaDeCompra (yyyyMmDd)']
+        if pd.isna(fecha_de_compra):
             fecha_de_compra = datetime.now(timezone(timedelta(hours=-6))).strftime('%Y-%m-%d') #TODO: make env variable for the store's local timezone and use throughout app. Also in db.
+        invalid_columns = row['invalidColumns']
 
         # Query shopify for the variant corresponding to this SKU
         variants = get_variants_by_sku(sku)
@@ -78,29 +156,36 @@ def complete_sheety_data(sheety_df: pd.DataFrame) -> pd.DataFrame:
                 'errors': f'No se encontró ningún producto con clave "{sku}".'
             })
             continue
-        elif new_price and not (isinstance(new_price, (int, float)) and 
-                                (0 < new_price <= 7000 or new_price != new_price)): # x != x is true if x is nan!
+        elif 'nuevoPrecioVenta' in invalid_columns or \
+                not (pd.isna(new_price) or 0 < new_price <= 7000):
             combined_data.append({
                 'sku': sku,
                 'errors': f'No es válido el precio de venta ingresado en este renglón (renglón {index + 2}).',
             })
             continue
-        elif new_cost and not (isinstance(new_cost, (int, float)) and 
-                                (0 < new_cost <= 20000 or new_cost != new_cost)):
+        elif 'nuevoPrecioCompra' in invalid_columns or \
+                not (pd.isna(new_cost) or 0 < new_cost <= 20000):
             combined_data.append({
                 'sku': sku,
                 'errors': f'No es válido el precio de compra ingresado en el renglón {index + 2}.'
             })
             continue
+        elif 'cantidadAAgregar' in invalid_columns:
+            combined_data.append({
+                'sku': sku,
+                'errors': f'No es válida la cantidad ingresada en el renglón {index + 2}.'
+            })
+            continue
+        new_price = None if pd.isna(new_price) else float(new_price)
+        new_cost = None if pd.isna(new_cost) else float(new_cost)
         
         variant = variants[0]
 
-        new_cost_history_value = variant['costHistoryValue']
-        new_cost_history_value.append({
-            "costo": new_cost,
-            "cantidad": qty,
-            "fecha de compra": fecha_de_compra,
-        })
+        new_cost_history_value = [
+            cost_history_entry(entry.get('costo'), entry.get('cantidad'), entry.get('fecha de compra'))
+            for entry in variant['costHistoryValue']
+        ]
+        new_cost_history_value.append(cost_history_entry(new_cost, qty, fecha_de_compra))
         new_cost_history = {
             "key": "cost_history",
             "namespace": "custom",
@@ -116,14 +201,14 @@ def complete_sheety_data(sheety_df: pd.DataFrame) -> pd.DataFrame:
             'displayName': variant['displayName'],
             'vendor': variant['vendor'],
             'newPrice': new_price,
-            'priceDelta': new_price - float(variant['price']),
+            'priceDelta': None if new_price is None else new_price - float(variant['price']),
             'newCost': new_cost,
-            'costDelta': new_cost - float(variant['unitCost']),
+            'costDelta': None if new_cost is None else new_cost - float(variant['unitCost']),
             'errors': 'none',
             'variantId': variant['variantId'],
             'productId': variant['productId'],
             'inventoryItemId': variant['inventoryItemId'],
-            'costHistory': json.dumps(new_cost_history),
+            'costHistory': new_cost_history,
         }
         combined_data.append(joined_product_data)
     
@@ -148,31 +233,38 @@ def get_variants_by_sku(sku:str) -> list[dict]:
       }
     ]
     """
+    variants = variant_cache.get_by_sku(sku)
+    if variants is not None:
+        return variants
+
     query = q.get_variants_by_sku % sku
 
     res = graphql_query(query)
     data = res.json()['data']
 
-    variants = []
-    for variant in data['productVariants']['nodes']:
-        unit_cost = variant['inventoryItem']['unitCost']
-        unit_cost = unit_cost['amount'] if unit_cost else nan
-        variant_data = {
-            "sku": sku,
-            "variantId": variant['id'],
-            "displayName": variant['displayName'],
-            "vendor": variant['product']['vendor'],
-            "price": variant['price'],
-            "unitCost": unit_cost,
-            "inventoryItemId": variant['inventoryItem']['id'],
-            "productId": variant['product']['id'],
-            "costHistoryValue": variant['metafield']['jsonValue'] if variant['metafield'] else [],
-            "costHistoryCompareDigest": variant['metafield']['compareDigest'] if variant['metafield'] else []
-        }
-        variants.append(variant_data)
+    variants = [variant_record(variant, sku, variant['product']) 
+                for variant in data['productVariants']['nodes']]
+    variant_cache.store_sku(sku, variants)
 
     return variants
 
+def variant_record(variant: dict, sku: str, product: dict) -> dict:
+    """A variant node (see get_variants_by_sku) in the format returned by get_variants_by_sku()."""
+    unit_cost = variant['inventoryItem']['unitCost']
+    unit_cost = unit_cost['amount'] if unit_cost else nan
+    return {
+        "sku": sku,
+        "variantId": variant['id'],
+        "displayName": variant['displayName'],
+        "vendor": product['vendor'],
+        "price": variant['price'],
+        "unitCost": unit_cost,
+        "inventoryItemId": variant['inventoryItem']['id'],
+        "productId": product['id'],
+        "costHistoryValue": variant['metafield']['jsonValue'] if variant['metafield'] else [],
+        "costHistoryCompareDigest": variant['metafield']['compareDigest'] if variant['metafield'] else None
+    }
+
 def set_variant_cost(inventory_item_id:str, cost:float) -> None:
     """
     Sets the unitCost for a product variant.
@@ -192,6 +284,10 @@ def set_variant_cost(inventory_item_id:str, cost:float) -> None:
     res = graphql_query(query, variables)
     raise_for_user_errors(res, 'inventoryItemUpdate')
 
+    unit_cost = res.json()['data']['inventoryItemUpdate']['inventoryItem']['unitCost']
+    for id in variant_cache.variant_ids_of_items([inventory_item_id]):
+        variant_cache.update_variant(id, unitCost=unit_cost['amount'] if unit_cost else nan)
+
 def set_variant_price(product_id:str, variant_id:Union[str, list[str]], price:Union[float, list[float]]) -> None:
     """
     Sets the price for a product variant, or for multiple product variants if 
@@ -229,10 +325,20 @@ def set_variant_price(product_id:str, variant_id:Union[str, list[str]], price:Un
     res = graphql_query(query, variables)
     raise_for_user_errors(res, 'productVariantsBulkUpdate')
 
-def adjust_variant_quantities(changes: list[dict], reason: str = 'received', name: str = 'available') -> None:
+    for variant in res.json()['data']['productVariantsBulkUpdate']['productVariants'] or []:
+        variant_cache.update_variant(variant['id'], price=variant['price'])
+
+INVENTORY_CHANGES_PER_CALL = 250 # max 'changes' per inventoryAdjustQuantities call
+
+def adjust_variant_quantities(changes: list[dict], reason: str = 'received', 
+                              name: str = 'available', max_workers: int = 4) -> list[dict]:
     """
     Adjust 'available' quainties for product variants.
 
+    Changes are sent in chunks of INVENTORY_CHANGES_PER_CALL, concurrently. A 
+    chunk is applied as a whole or not at all, so a chunk rejected because of 
+    some of its items is sent again without them. 
+
     Params:
     - changes: a list of changes. Each change is a dict with 'inventoryItemId' 
     and 'delta' (how many items to add/subract) keys. (Note: delta can be 
@@ -241,6 +347,14 @@ def adjust_variant_quantities(changes: list[dict], reason: str = 'received', nam
     - reason: the reason for the changes. 
     See possible values: https://shopify.dev/docs/apps/build/orders-fulfillment/inventory-management-apps/manage-quantities-states#set-inventory-quantities-on-hand
     - name: also see docs for possible names
+
+    Returns one result per change, in the same order:
+    {
+        "inventoryItemId": "gid://shopify/InventoryItem/1234567890",
+        "delta": 20,
+        "adjusted": True,
+        "error": None # or the error message if adjusted is False
+    }
     
     Example:
     e.g. changes = [
@@ -253,28 +367,79 @@ def adjust_variant_quantities(changes: list[dict], reason: str = 'received', nam
             "delta": 33
         },
     ]
-    adjust_variant_quantities(changes=changes)
+    results = adjust_variant_quantities(changes=changes)
     """
     # TODO: perhaps make the referenceDocumentUri the URI of the AdminAction that made this change.
     # see: https://shopify.dev/docs/api/admin-graphql/2025-01/mutations/inventoryAdjustQuantities
     
     LOCATION_ID = current_app.config['SHOPIFY_LOCATION_ID']
-    changes_with_id = [
-        {**change, "locationId": LOCATION_ID} for change in changes
-    ]
-    query = q.adjust_variant_quantities
-    variables = {
-        "input": {
-            "reason": reason,
-            "name": name,
-            "changes": changes_with_id
+    results = [{'inventoryItemId': change['inventoryItemId'], 'delta': int(change['delta']),
+                'adjusted': False, 'error': None} for change in changes]
+    
+    # chunks hold positions in `results` so that each item's outcome can be recorded
+    positions = list(range(len(results)))
+    chunks = [positions[i:i+INVENTORY_CHANGES_PER_CALL] 
+              for i in range(0, len(positions), INVENTORY_CHANGES_PER_CALL)]
+
+    def variables(chunk: list[int]) -> dict:
+        return {
+            "input": {
+                "reason": reason,
+                "name": name,
+                "changes": [{
+                    "inventoryItemId": results[i]['inventoryItemId'],
+                    "delta": results[i]['delta'],
+                    "locationId": LOCATION_ID
+                } for i in chunk]
+            }
         }
-    }
-    res = graphql_query(query, variables)
-    raise_for_user_errors(res, 'inventoryAdjustQuantities')
-    current_app.logger.info(f"Inventory adjusted for {len(changes)} variants. Response: {res.text}")
 
-def set_metafields(metafields=list[dict]) -> str:
+    # a chunk is retried at most once without the items that caused user errors
+    for retry in (False, True):
+        responses = run_mutation_batches(q.adjust_variant_quantities, 
+                                         [variables(chunk) for chunk in chunks],
+                                         queried_field='inventoryAdjustQuantities',
+                                         max_workers=max_workers)
+        failed_chunks = []
+        for chunk, response in zip(chunks, responses):
+            if response['error']:
+                for i in chunk:
+                    results[i]['error'] = response['error']
+            elif not response['userErrors']:
+                for i in chunk:
+                    results[i]['adjusted'] = True
+                    results[i]['error'] = None
+                current_app.logger.info(f"Inventory adjusted for {len(chunk)} variants.")
+            else:
+                error_msg = str(response['userErrors'])
+                bad_indices = user_error_indices(response['userErrors'], 'changes')
+                if retry or bad_indices is None:
+                    for i in chunk:
+                        results[i]['error'] = error_msg
+                    continue
+                for j, i in enumerate(chunk):
+                    if j in bad_indices:
+                        results[i]['error'] = error_msg
+                remaining = [i for j, i in enumerate(chunk) if j not in bad_indices]
+                if remaining:
+                    failed_chunks.append(remaining)
+        chunks = failed_chunks
+        if not chunks:
+            break
+
+    # cached records are read again after their inventory changes
+    variant_cache.forget_variants(variant_cache.variant_ids_of_items(
+        result['inventoryItemId'] for result in results if result['adjusted']))
+
+    failed = [result for result in results if not result['adjusted']]
+    if failed:
+        current_app.logger.error(f"Could not adjust inventory for {len(failed)} of {len(results)} variants.")
+
+    return results
+
+METAFIELDS_PER_BATCH = 25 # metafieldsSet accepts at most 25 metafields per call
+
+def set_metafields(metafields: list[dict], max_workers: int = 4) -> dict:
     '''
     Each metafield in the list should have the following format.
     {
@@ -287,66 +452,122 @@ def set_metafields(metafields=list[dict]) -> str:
     }
     For supported types see: https://shopify.dev/docs/apps/build/custom-data/metafields/list-of-data-types
 
-    Returns error message to show user if there is an error.
+    Batches of 25 metafields are sent concurrently. A batch rejected because of 
+    some of its metafields is sent again without them, so one bad metafield 
+    does not block the other 24.
+
+    Does not raise on failed batches. Returns a report:
+    {
+      "updated": number of metafields set,
+      "failed_owner_ids": ownerIds of the metafields that could not be set,
+      "errors": error messages to show the user
+    }
     '''
-    for metafield in metafields:
-        metafield['value'] = json.dumps(metafield['value'])
-    query = q.set_metafields
-    for i in range(0, len(metafields), 25): # we can only upload 25 metafields at a time
-        batch = metafields[i:i+25]
-        variables = {
-            "metafields": batch
-        }
-        try:
-            res = graphql_query(query, variables)
-            raise_for_user_errors(res, queried_field='metafieldsSet')
-        except:
-            current_app.logger.error(f"Errors encountered while uploading {len(batch)} metafields. Problem batch is from metafield #{i+1} to #{i+len(batch)}.")
-            raise
-        else:
-            current_app.logger.info(f'{len(batch)} metafields updated in batch #{i/25 + 1}.')
-
-def get_variants_using_query(query: str, cursor: str=None) -> tuple[list[dict], str]:
-    """Get useful information on the variants and their respective product.
-
-    Returns (products, cursor) duple.
-    - products: list[dict]
-    - endCursor: str | None
-      - endCursor is None if there is no next page.
-    
-    Params
-    - query: will be used as the 'query' variable in the graphql query below:
-
-    Query:
-    ```
-    query GetProductVariants ($query: String!) {
-      productVariants(first: 3, query:$query) {
-        nodes {
-          # some fields
-        }
-      }
+    # the compareDigest of cached cost histories changes whether or not they are 
+    # set (if setting one failed, it is likely to be outdated)
+    variant_cache.forget_variants(metafield['ownerId'] for metafield in metafields)
+
+    metafields = [{**metafield, 'value': json.dumps(metafield['value'])} 
+                  for metafield in metafields]
+    batches = [metafields[i:i+METAFIELDS_PER_BATCH] 
+               for i in range(0, len(metafields), METAFIELDS_PER_BATCH)]
+    report = {'updated': 0, 'failed_owner_ids': [], 'errors': []}
+
+    def fail(batch: list[dict], message: str):
+        report['failed_owner_ids'].extend(metafield['ownerId'] for metafield in batch)
+        report['errors'].append(message)
+        current_app.logger.error(f"Could not set {len(batch)} metafields: {message}")
+
+    # a batch is retried at most once without the metafields that caused user errors
+    for retry in (False, True):
+        results = run_mutation_batches(q.set_metafields, 
+                                       [{"metafields": batch} for batch in batches],
+                                       queried_field='metafieldsSet',
+                                       max_workers=max_workers)
+        batches = []
+        for result in results:
+            batch = result['variables']['metafields']
+            if result['error']:
+                fail(batch, result['error'])
+            elif not result['userErrors']:
+                report['updated'] += len(batch)
+                current_app.logger.info(f'{len(batch)} metafields updated.')
+            else:
+                bad_indices = user_error_indices(result['userErrors'], 'metafields')
+                if retry or bad_indices is None:
+                    fail(batch, str(result['userErrors']))
+                    continue
+                fail([batch[i] for i in sorted(bad_indices)], str(result['userErrors']))
+                remaining = [m for i, m in enumerate(batch) if i not in bad_indices]
+                if remaining:
+                    batches.append(remaining)
+        if not batches:
+            break
+
+    return report
+
+def products_search_query(estado: str = None, pueblo: str = None, vendor: str = None) -> str:
+    """
+    Shopify product search query for the products with all the given values, 
+    e.g. products_search_query(estado='Oaxaca', vendor="D'Ana") -> 
+    "metafields.custom.estado:'Oaxaca' AND vendor:'D\\'Ana'"
+    """
+    fields = {'metafields.custom.estado': estado, 'metafields.custom.pueblo': pueblo, 
+              'vendor': vendor}
+    return ' AND '.join(f"{field}:'{_search_escape(value)}'" 
+                        for field, value in fields.items() if value)
+
+def _search_escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+def iter_variants_using_query(query: str) -> Iterator[dict]:
+    """
+    Yields the products matching a Shopify product search query, with all of 
+    their variants, one product at a time. Pages are requested as the products 
+    are consumed, so results can be streamed.
+
+    Each product:
+    {
+        'vendor', 'title', 'pueblo', 'estado',
+        'variants': [{'variantTitle', 'cost', 'costHistory', 'price', 'sku', 'quantity'}]
     }
-    ```
+
+    Params
+    - query: Shopify search syntax, e.g. "vendor:'Juan' AND metafields.custom.estado:'Oaxaca'"
     """
-    query = q.get_variants_from_products_query % query
-    # variables = {
-    #     "query": f'"{query}"'
-    # } TODO: why does this not work?
-    try:
-        res = graphql_query(query)
-        print(json.dumps(res.text))
-    except Exception as e:
-        current_app.logger.warning(f"Errors encountered while retrieving queried products.\n  query: {query}\n  Error: {e}")
-        raise
-    
-    page_info = res.json()['data']['products']['pageInfo']
-    if page_info['hasNextPage']:
-        end_cursor = page_info['endCursor']
-    else:
-        end_cursor = None
-    
-    return res.json()['data']['products']['nodes'], end_cursor
-    # TODO implement pagination
+    location_id = current_app.config['SHOPIFY_LOCATION_ID']
+    products = iter_connection(q.get_variants_from_products_query,
+                               {'query': query, 'locationId': location_id},
+                               ['products'], page_size=25)
+    for node in products:
+        variants = node['variants']['nodes']
+        if node['variants']['pageInfo']['hasNextPage']:
+            # the query only brings the first few variants of each product
+            variants = chain(variants, iter_connection(
+                q.get_product_variants_query, {'id': node['id'], 'locationId': location_id},
+                ['product', 'variants'],
+                after=node['variants']['pageInfo']['endCursor']))
+
+        metafields = {meta['key']: meta['value'] for meta in node['metafields']['nodes']}
+        yield {
+            'vendor': node['vendor'],
+            'title': node['title'],
+            'pueblo': metafields.get('custom.pueblo'),
+            'estado': metafields.get('custom.estado'),
+            'variants': [{
+                'variantTitle': variant['title'],
+                'cost': (variant['inventoryItem']['unitCost'] or {}).get('amount'),
+                'costHistory': variant['metafield'] if variant['metafield'] else None,
+                'price': variant['price'],
+                'sku': variant['sku'],
+                'quantity': _available_quantity(variant['inventoryItem']['inventoryLevel']),
+            } for variant in variants],
+        }
+
+def _available_quantity(inventory_level: dict | None) -> int | None:
+    if not inventory_level or not inventory_level['quantities']:
+        return None
+    return inventory_level['quantities'][0]['quantity']
 
 def valid_sku(sku: str) -> bool:
     valid_chars = '^[0-9a-zA-ZáéíóúÁÉÍÓÚñÑ_-]*$'
@@ -356,6 +577,8 @@ def sku_available(sku: str) -> bool:
     '''True if sku is available and contains no special characters and is not too long.'''
     if not valid_sku(sku):
         return False
+    if variant_cache.get_by_sku(sku):
+        return False
     
     query = q.get_variant_id_by_sku % sku
 
@@ -1,52 +1,246 @@
+import io
+import os
+import json
+import multiprocessing
+import hashlib
+from threading import Lock
+from itertools import islice, groupby
+from typing import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
+import pikepdf
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.pdfbase.pdfmetrics import stringWidth
 
-def generate_pdf(data: pd.DataFrame, pdf_output):
+# Change when the rendering changes, so that PDFs cached by labels_hash() are
+# rendered again
+RENDERER_VERSION = 1
+# Label sheet layout, in points
+LABEL_LAYOUT = {
+    'x_start': 40,
+    'y_start': 710,
+    'cols': 8,
+    'rows': 23,
+    'width': 64,
+    'height': 30,
+    'padding': 0,
+    'price_font': ['Helvetica-Bold', 11],
+    'sku_font': ['Helvetica', 10],
+}
+# Splitting the pages between processes and merging their PDFs adds about 40% 
+# to the rendering time, so it only pays off for long runs and with a CPU per 
+# process. Measured (best of 3; each worker's share of the work and the merge 
+# timed on one CPU, so the parallel times assume a free CPU per worker):
+#   labels  serial  2 workers  4 workers
+#   10000   0.32 s  0.37 s     0.37 s
+#   30000   0.86 s  0.63 s     0.86 s
+#   60000   1.78 s  1.58 s     1.24 s
+PARALLEL_MIN_LABELS = 30000
+
+_pool = None
+_pool_lock = Lock()
+
+def iter_labels(data: pd.DataFrame) -> Iterator[tuple[str, float]]:
     """
-    Generate a PDF from given data. Supports file paths and in-memory buffers.
-    
-    If pdf_output is buffer, cursor is reset and buffer is ready for reading.
+    Yields (sku, price) once per label to print, in order. Rows with a missing
+    sku, price or quantity are skipped.
     """
-    c = canvas.Canvas(pdf_output, pagesize=letter)
-    x_start, y_start = 40, 710
+    data = data.rename(columns=str.lower)
+    data = data.dropna(subset=['sku', 'precio', 'cantidad'])
+    for sku, price, qty in zip(data['sku'], data['precio'], data['cantidad']):
+        label = (str(sku), float(price))
+        for _ in range(int(qty)):
+            yield label
+
+def labels_hash(data: pd.DataFrame, layout: dict = LABEL_LAYOUT) -> str:
+    """
+    SHA-256 of what generate_pdf() would draw for data: the labels in order,
+    the layout and RENDERER_VERSION. Rows that print nothing don't change it.
+    """
+    runs = [[sku, price, len(list(group))] 
+            for (sku, price), group in groupby(iter_labels(data))]
+    payload = json.dumps({'version': RENDERER_VERSION, 'layout': layout, 'labels': runs},
+                         sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
-    data.columns = data.columns.str.lower()
-    current_rectangle = 0
-    cols, rows = 8, 23
-    width, height = 64, 30
-    padding = 0
-    max_per_page = cols * rows
+def price_text(price: float) -> str:
+    return f"${int(price):,}" if price == int(price) else f"${price:,.2f}"
 
-    for _, row in data.iterrows():
-        sku, price, qty = row['sku'], row['precio'], row['cantidad']
-        for _ in range(qty):
-            x = x_start + (current_rectangle % cols) * (width + padding)
-            y = y_start - (current_rectangle // cols) * (height + padding)
+class LabelRenderer:
+    """
+    Draws labels on a canvas, page by page. The content of each distinct
+    (sku, price) is drawn once as a form XObject and then placed wherever the
+    label repeats. The frame grid is a form too, so every full page reuses the
+    same one.
+    """
+    def __init__(self, c: canvas.Canvas, layout: dict = LABEL_LAYOUT):
+        self.c = c
+        self.layout = layout
+        self.forms = {} # (sku, price): form name
+        self.grids = {} # number of cells: form name
+
+    def form_for(self, label: tuple[str, float]) -> str:
+        name = self.forms.get(label)
+        if name is None:
+            name = f'label{len(self.forms)}'
+            self._draw_form(name, *label)
+            self.forms[label] = name
+        return name
+
+    def _draw_form(self, name: str, sku: str, price: float) -> None:
+        c, layout = self.c, self.layout
+        width, height = layout['width'], layout['height']
+        # the form's box clips its content: leave room for text wider than the label
+        c.beginForm(name, lowerx=-width, lowery=-height, upperx=2 * width, uppery=2 * height)
 
+        text = price_text(price)
+        c.setFont(*layout['price_font'])
+        c.drawString((width - stringWidth(text, *layout['price_font'])) / 2,
+                     height // 2 + 1, text)
+
+        c.setFont(*layout['sku_font'])
+        c.drawString((width - stringWidth(sku, *layout['sku_font'])) / 2,
+                     height - 24, sku)
+        c.endForm()
+
+    def grid_for(self, count: int) -> str:
+        """Form with the frames of the first count cells of a page."""
+        name = self.grids.get(count)
+        if name is None:
+            name = f'grid{count}'
+            c, layout = self.c, self.layout
+            c.beginForm(name)
             c.setStrokeColorRGB(0.05, 0.05, 0.05)
             c.setLineWidth(0.1)
-            c.rect(x, y, width, height)
+            frames = c.beginPath()
+            for x, y in self.cell_origins(count):
+                frames.rect(x, y, layout['width'], layout['height'])
+            c.drawPath(frames, stroke=1, fill=0)
+            c.endForm()
+            self.grids[count] = name
+        return name
 
-            price_font, price_font_size = "Helvetica-Bold", 11
-            sku_font, sku_font_size = "Helvetica", 10
+    def cell_origins(self, count: int) -> list[tuple[float, float]]:
+        """Lower left corners of the first count cells of a page."""
+        layout = self.layout
+        cols = layout['cols']
+        step_x = layout['width'] + layout['padding']
+        step_y = layout['height'] + layout['padding']
+        return [(layout['x_start'] + (i % cols) * step_x,
+                 layout['y_start'] - (i // cols) * step_y)
+                for i in range(count)]
 
-            c.setFont(price_font, price_font_size)
-            price_text = f"${int(price):,}" if price == int(price) else f"${price:,.2f}"
-            price_text_width = stringWidth(price_text, price_font, price_font_size)
-            c.drawString(x + (width - price_text_width) / 2, y + height // 2 + 1, price_text)
+    def draw_page(self, labels: list[tuple[str, float]]) -> None:
+        c = self.c
+        # forms are defined before anything is drawn on the page
+        forms = [self.form_for(label) for label in labels]
+        c.doForm(self.grid_for(len(labels)))
 
-            c.setFont(sku_font, sku_font_size)
-            sku_text = f"{sku}"
-            sku_text_width = stringWidth(sku_text, sku_font, sku_font_size)
-            c.drawString(x + (width - sku_text_width) / 2, y + height - 24, sku_text)
+        for form, (x, y) in zip(forms, self.cell_origins(len(labels))):
+            c.saveState()
+            c.translate(x, y)
+            c.doForm(form)
+            c.restoreState()
+        c.showPage()
 
-            current_rectangle += 1
-            if current_rectangle == max_per_page:
-                c.showPage()
-                current_rectangle = 0
+def paginate(labels: Iterable[tuple[str, float]],
+             layout: dict = LABEL_LAYOUT) -> Iterator[list[tuple[str, float]]]:
+    """Splits labels into lists of at most one page of labels."""
+    per_page = layout['cols'] * layout['rows']
+    labels = iter(labels)
+    while page := list(islice(labels, per_page)):
+        yield page
 
+def render_pages(pages: Iterable[list[tuple[str, float]]], pdf_output,
+                 layout: dict = LABEL_LAYOUT) -> None:
+    c = canvas.Canvas(pdf_output, pagesize=letter)
+    renderer = LabelRenderer(c, layout)
+    for page in pages:
+        renderer.draw_page(page)
     c.save()
+
+def render_pages_to_bytes(pages: list[list[tuple[str, float]]],
+                          layout: dict = LABEL_LAYOUT) -> bytes:
+    buffer = io.BytesIO()
+    render_pages(pages, buffer, layout)
+    return buffer.getvalue()
+
+def _render_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    The process's pool of render workers, started on first use and kept for
+    later PDFs. Workers are forked from a forkserver that has already imported
+    this module (and so the app package, about 2 s), so they start ready to 
+    render. A forkserver is used because forking a process with other threads 
+    running (archive queue, boto3 pools) can copy locks held by them and 
+    deadlock.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([__name__])
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        return _pool
+
+def render_pages_parallel(pages: list[list[tuple[str, float]]], pdf_output,
+                          workers: int, layout: dict = LABEL_LAYOUT) -> None:
+    """
+    Renders pages in one chunk per worker, in the pool of worker processes, and
+    concatenates them, in order, into pdf_output (a path or a binary stream).
+    Every chunk draws its own label forms, so fewer, larger chunks are faster.
+    """
+    global _pool
+    size = -(-len(pages) // workers)
+    chunks = [pages[i:i + size] for i in range(0, len(pages), size)]
+    # qpdf (through pikepdf) concatenates several times faster than pure 
+    # python PDF libraries, which would take about as long as rendering
+    merged = pikepdf.Pdf.new()
+    parts = []
+    try:
+        # map returns the chunks in order
+        for pdf_bytes in _render_pool(workers).map(render_pages_to_bytes, chunks, 
+                                                   [layout] * len(chunks)):
+            part = pikepdf.Pdf.open(io.BytesIO(pdf_bytes))
+            merged.pages.extend(part.pages)
+            parts.append(part) # pages are copied from their source when saving
+    except BrokenProcessPool:
+        # a worker died: start a new pool next time
+        with _pool_lock:
+            _pool = None
+        raise
+    merged.save(pdf_output)
+
+def parallel_workers(label_count: int, workers: int, 
+                     min_labels: int = PARALLEL_MIN_LABELS) -> int:
+    """
+    Number of processes to render label_count labels with: at most workers and
+    the number of CPUs, and 1 (render in this process) for runs shorter than 
+    min_labels, which are not faster in parallel.
+    """
+    if label_count < min_labels:
+        return 1
+    return max(1, min(workers, os.cpu_count() or 1))
+
+def generate_pdf(data: pd.DataFrame, pdf_output, workers: int = 1, 
+                 min_parallel_labels: int = PARALLEL_MIN_LABELS):
+    """
+    Generate a PDF from given data. Supports file paths and in-memory buffers.
+
+    If pdf_output is buffer, cursor is reset and buffer is ready for reading.
+
+    With workers > 1, runs of at least min_parallel_labels labels are rendered 
+    in up to that many processes (see parallel_workers and render_pages_parallel).
+    """
+    pages = paginate(iter_labels(data))
+    if workers > 1:
+        pages = list(pages)
+        label_count = sum(len(page) for page in pages)
+        workers = parallel_workers(label_count, workers, min_parallel_labels)
+    if workers > 1:
+        render_pages_parallel(pages, pdf_output, workers)
+    else:
+        render_pages(pages, pdf_output)
     if hasattr(pdf_output, "getvalue"):
         pdf_output.seek(0)
@@ -1,53 +1,63 @@
-import os
-import json
 import io
+import os
+import csv
 from datetime import datetime, timezone
-from flask import redirect, url_for, request, flash, render_template, send_file, \
-    current_app, jsonify, Response
+from flask import redirect, url_for, request, flash, render_template, \
+    current_app, jsonify, Response, stream_template, stream_with_context, send_file
 from flask_login import login_required, current_user
 import sqlalchemy as sa
-from app import db, storage_service
-from app.models import AdminAction, Vendor, File, Metadata
+from app import db, archive_queue, storage_service
+from app.models import AdminAction, Vendor, File, Metadata, CatalogProduct
 from app.utils import get_timestamp
+from app.pagination import keyset_paginate
 from app.shop import bp
-from app.shop.forms import SubmitForm, QueryProductsForm
-from app.shop.price_tags import generate_pdf
+from app.shop.forms import SubmitForm, QueryProductsForm, BatchFileForm, \
+    CatalogSearchForm
+from app.shop.price_tags import generate_pdf, labels_hash
+from app.integrations.storage import StorageNotFoundError
 from app.integrations.sheety import clear_inventory_updates_sheet, \
     fetch_etiquetas, fetch_inventory_updates
-from app.integrations.gsheets import append_df_to_sheet, clear_sheet_except_header
+from app.integrations.gsheets import SheetBatch
 from app.shop.inventory import get_local_inventory, delete_local_inventory, \
     write_local_inventory, complete_sheety_data, adjust_variant_quantities, \
-        set_variant_price, set_variant_cost, set_metafields, get_variants_using_query
+        set_variant_price, set_variant_cost, set_metafields, iter_variants_using_query, \
+        products_search_query, inventory_records
 from app.shop.captura import get_captura, captura_cleanup_and_validation, \
-    add_product_handles, upload_to_shopify, add_cost_histories
+    add_product_handles, upload_to_shopify, add_cost_histories, stage_captura, \
+        get_staged_captura, delete_staged_captura
+from app.shop.batch_files import BatchFileError, inventory_updates_from_file
+from app.shop.catalog import FACETS, search_query, facet_counts, spelled_as_facets
 
 @bp.route('/etiquetas-generar-pdf')
 @login_required
 def generate_labels():
     data = fetch_etiquetas()
     timestamp = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')
-    pdf_path = os.path.join(current_app.config['DATA_DIR'], f"pdfs/etiquetas_{timestamp}.pdf")
-    if current_app.config['USE_LOCAL_STORAGE']:
-        os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
-        generate_pdf(data, pdf_path)
-        
-        return send_file(pdf_path, as_attachment=True, download_name=pdf_filename)
-    else:
-        data = fetch_etiquetas()
+    pdf_filename = f"labels_{timestamp}.pdf"
+    headers = {"Content-Disposition": f"attachment; filename={pdf_filename}"}
 
-        pdf_buffer = io.BytesIO()
-        generate_pdf(data, pdf_buffer)
-        
-        timestamp = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')
-        pdf_filename = f"labels_{timestamp}.pdf"
-
-        storage = storage_service()
-        pdf_content = pdf_buffer.getvalue()
-        storage.upload_bytes(f'labels/{pdf_filename}', io.BytesIO(pdf_content), content_type='application/pdf')
-
-        return Response(pdf_content, content_type="application/pdf", headers={
-            "Content-Disposition": f"attachment; filename={pdf_filename}"
-        })
+    # Reprints of the same labels are served from the archive. The cache entry
+    # holds the archive key of the PDF rendered for these labels.
+    storage = storage_service()
+    cache_key = f'labels/cache/{labels_hash(data)}'
+    try:
+        archive_key = storage.download_text(cache_key)
+        if storage.exists(archive_key):
+            return Response(storage.iter_archive(archive_key), 
+                            content_type="application/pdf", headers=headers)
+    except StorageNotFoundError:
+        pass
+
+    # reportlab assembles the whole document in memory before writing it, so 
+    # nothing could be sent before every page is rendered: the PDF is kept in 
+    # memory (about 0.5 MB for 60k labels) and sent once complete
+    pdf_buffer = io.BytesIO()
+    generate_pdf(data, pdf_buffer, workers=current_app.config['LABELS_MAX_WORKERS'],
+                 min_parallel_labels=current_app.config['LABELS_PARALLEL_MIN_LABELS'])
+    archive_queue().submit(f'labels/{pdf_filename}', pdf_buffer.getvalue(),
+                           on_archived=lambda key, _: storage_service().upload_text(cache_key, key))
+    return send_file(pdf_buffer, mimetype="application/pdf", as_attachment=True, 
+                     download_name=pdf_filename)
 
 @bp.route('/etiquetas')
 @login_required
@@ -60,73 +70,117 @@ def products():
     form = QueryProductsForm()
 
     if form.validate_on_submit():
-        state = f"metafields.custom.estado:'{form.state.data}'" if form.state.data else ''
-        town = f"metafields.custom.pueblo:'{form.town.data}'" if form.town.data else ''
-        vendor = f"vendor:'{form.vendor.data}'" if form.vendor.data else ''
-
-        filters = [field for field in [state, town, vendor] if field]
+        filters = {'estado': form.state.data, 'pueblo': form.town.data, 
+                   'vendor': form.vendor.data}
+        filters = {name: value.strip() for name, value in filters.items() 
+                   if value and value.strip()}
 
         if not filters:
             flash('No seleccionaste ningún filtro.', 'warning')
             return redirect(url_for('shop.products'))
-        
-        query = ' AND '.join(filters)
-        print(f'{query = }')
 
-        return redirect(url_for('shop.query_products', query=query))
+        return redirect(url_for('shop.search_products', **filters))
 
     return render_template('shop/products_search.html', form=form)
 
+@bp.route('/productos-catalogo')
+@login_required
+def search_products():
+    '''Searches the local catalog, updated by the bulk sync, without querying Shopify.'''
+    form = CatalogSearchForm(request.args)
+    text = form.q.data or ''
+    filters = {name: request.args.get(name) for name in FACETS if request.args.get(name)}
+    # filters ignore case and accents: values typed in the products form (e.g. 
+    # 'michoacan') are shown and linked as spelled in the catalog ('Michoacán')
+    facets = facet_counts(text, filters)
+    filters = spelled_as_facets(filters, facets)
+
+    products = keyset_paginate(search_query(text, filters), 
+                               [(CatalogProduct.title, False), (CatalogProduct.id, False)],
+                               per_page=current_app.config['PRODUCTS_PER_PAGE'],
+                               after=request.args.get('after'),
+                               before=request.args.get('before'))
+    pagination = {
+        'start': products.start,
+        'next_url': url_for('shop.search_products', q=text, after=products.next_cursor, **filters) \
+            if products.has_next else None,
+        'prev_url': url_for('shop.search_products', q=text, before=products.prev_cursor, **filters) \
+            if products.has_prev else None,
+    }
+    # live quantities and costs of the filtered products, from Shopify
+    shopify_url = url_for('shop.query_products', query=products_search_query(**filters)) \
+        if filters else None
+
+    return render_template('shop/products_catalog.html', form=form, text=text,
+                           products=products, pagination=pagination, filters=filters,
+                           facets=facets, shopify_url=shopify_url)
+
 @bp.route('/productos-busqueda', methods=['GET', 'POST'])
 @login_required
 def query_products():
     query = request.args.get('query')
-    print(query)
     if not query:
         flash('Something went wrong.', 'error')
         current_app.logger.error('No query was entered.')
         return redirect(url_for('dashboard.index'))
     
-    nodes, cursor = get_variants_using_query(query)
-
-    # if cursor: # TODO along with the to-do inget_variants_using_query()
-        # show next page button
-    prods = []
-    for node in nodes:
-        metafields = {meta['key']: meta['value'] for meta in node['metafields']['nodes']}
-        prod = {
-            'vendor': node['vendor'],
-            'title': node['title'],
-            'pueblo': metafields.get('custom.pueblo'),
-            'estado': metafields.get('custom.estado'),
-            'variants': [{
-                'variantTitle': variant['title'],
-                'cost': variant['inventoryItem']['unitCost']['amount'],
-                'costHistory': variant['metafield'] if variant['metafield'] else None,
-                'price': variant['price'],
-                'sku': variant['sku'],
-                'quantity': variant['inventoryItem']['inventoryLevel']['quantities'][0]['quantity'],
-            } for variant in node['variants']['nodes']],
-        }
-        prods.append(prod)
+    errors = []
+    return stream_template('shop/products_results.html', query=query, errors=errors,
+                           products=_products_or_error(query, errors))
 
-    
-    return render_template('shop/products_results.html', products=prods)
+@bp.route('/productos-busqueda.csv')
+@login_required
+def export_products():
+    query = request.args.get('query')
+    if not query:
+        flash('Something went wrong.', 'error')
+        current_app.logger.error('No query was entered.')
+        return redirect(url_for('dashboard.index'))
+
+    def rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['Proveedor', 'Título', 'Pueblo', 'Estado', 'Título de variante', 
+                         'Clave (SKU)', 'Precio', 'Costo por unidad', 'Cantidad Actual'])
+        for prod in _products_or_error(query, []):
+            for variant in prod['variants']:
+                writer.writerow([prod['vendor'], prod['title'], prod['pueblo'], prod['estado'],
+                                 variant['variantTitle'], variant['sku'], variant['price'],
+                                 variant['cost'], variant['quantity']])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    timestamp = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')
+    headers = {"Content-Disposition": f"attachment; filename=productos_{timestamp}.csv"}
+    return Response(stream_with_context(rows()), content_type='text/csv; charset=utf-8', 
+                    headers=headers)
+
+def _products_or_error(query: str, errors: list):
+    '''
+    Products from iter_variants_using_query(). The response has already started
+    when they are streamed, so a failed page ends the results and its error is
+    added to errors instead of being raised.
+    '''
+    try:
+        yield from iter_variants_using_query(query)
+    except Exception as e:
+        current_app.logger.error(f'Product query interrupted. query: {query} Error: {e}')
+        errors.append('La consulta a Shopify se interrumpió, los resultados están incompletos.')
 
 @bp.route('/artesanos')
 @login_required
 def vendors():
-    page = request.args.get('page', 1, int)
-    query = sa.select(Vendor).order_by(Vendor.name)
-
-    vendors = db.paginate(query, page=page, 
-                        per_page=current_app.config.get('VENDORS_PER_PAGE', 50), 
-                        error_out=False)
+    # name is unique, so it's enough to seek by
+    vendors = keyset_paginate(sa.select(Vendor), [(Vendor.name, False)], 
+                              per_page=current_app.config.get('VENDORS_PER_PAGE', 50),
+                              after=request.args.get('after'), 
+                              before=request.args.get('before'))
     pagination = {
-        'page': page,
-        'next_url': url_for('shop.vendors', page=vendors.next_num) \
+        'start': vendors.start,
+        'next_url': url_for('shop.vendors', after=vendors.next_cursor) \
             if vendors.has_next else None,
-        'prev_url': url_for('shop.vendors', page=vendors.prev_num) \
+        'prev_url': url_for('shop.vendors', before=vendors.prev_cursor) \
             if vendors.has_prev else None,
     }
 
@@ -141,6 +195,7 @@ def update_product_quantities():
     confirm_form.submit.label.text = 'Subir a Shopify'
 
     if request.method == 'GET':
+        file_form = BatchFileForm()
         df, time, total_errors = get_local_inventory()
         data = None
         enable_upload_btn = False
@@ -150,14 +205,12 @@ def update_product_quantities():
                 flash(f'No es posible subir los productos actualmente: hay {total_errors} SKU con errores.', 'warning')
             else:
                 enable_upload_btn=True
-            data = json.loads(df.to_json(orient='records'))
-            for row in data:
-                if row.get('costHistory'):
-                    row['costHistory'] = json.loads(row['costHistory'])
+            data = inventory_records(df)
 
         return render_template('shop/actualizar_cantidades.html', 
                         refresh_form=refresh_form, confirm_form=confirm_form, 
-                        data=data, time=time, enable_upload=enable_upload_btn)
+                        file_form=file_form, data=data, time=time, 
+                        enable_upload=enable_upload_btn)
     
     if refresh_form.validate_on_submit():  # Only refresh_form targets this view on submit.
         sheety = fetch_inventory_updates()
@@ -172,6 +225,32 @@ def update_product_quantities():
         write_local_inventory(df)
 
         return redirect(url_for('shop.update_product_quantities'))
+
+@bp.route('/cantidades-archivo', methods=['POST'])
+@login_required
+def upload_inventory_updates_file():
+    '''Same as refreshing from Google Sheets, with the rows of a CSV/XLSX file.'''
+    file_form = BatchFileForm()
+    if not file_form.validate_on_submit():
+        for error in file_form.file.errors:
+            flash(error, 'error')
+        return redirect(url_for('shop.update_product_quantities'))
+
+    file = file_form.file.data
+    try:
+        updates = inventory_updates_from_file(file.stream, file.filename)
+    except BatchFileError as e:
+        current_app.logger.warning(e)
+        flash(f'No se pudo leer el archivo "{file.filename}".', 'error')
+        return redirect(url_for('shop.update_product_quantities'))
+
+    if updates.shape[0] == 0:
+        flash(f'No se encontraron productos en el archivo "{file.filename}".', 'error')
+        delete_local_inventory()
+    else:
+        write_local_inventory(complete_sheety_data(updates))
+
+    return redirect(url_for('shop.update_product_quantities'))
     
 @bp.route('/cantidades-cargando', methods=['POST'])
 @login_required
@@ -204,25 +283,39 @@ def upload_product_quantities():
               'warning')
         return jsonify({'redirect_url': url_for('shop.update_product_quantities')})
 
+    if df is None or df.shape[0] == 0:
+        flash('No hay cambios de inventario para subir.', 'warning')
+        return jsonify({'redirect_url': url_for('shop.update_product_quantities')})
+
     # TODO: check for updates in sheety before adjusting. Don't do it if timestamp is very recent.
 
     # UPDATE INVENTORY QUANTITIES
+    # rows without a quantity only change prices, costs or cost histories
+    quantity_rows = df.loc[df['quantity'].notna() & (df['quantity'] != 0)]
     quantity_changes = [
         {
             'inventoryItemId': row['inventoryItemId'],
-            'delta': row['quantity']
+            'delta': int(row['quantity'])
         } 
-        for _, row in df.iterrows() ]
-    try:
-        adjust_variant_quantities(quantity_changes)
-    except:
-        flash('Fracasó el intento de actualizar el inventario. Si el error persiste, contacta a un administrador.', 'error')
-        return jsonify({'redirect_url': url_for('shop.update_product_quantities')})
-    
-    flash("Se actualizaron las cantidades correctamente.")
-    update_quantities_action = AdminAction(action="Actualizar cantidades de inventario", status='Completado', admin=current_user)
-    db.session.add(update_quantities_action)
-    db.session.commit()
+        for _, row in quantity_rows.iterrows() ]
+    if quantity_changes:
+        adjustments = adjust_variant_quantities(quantity_changes)
+        failed_items = [adj['inventoryItemId'] for adj in adjustments if not adj['adjusted']]
+        if len(failed_items) == len(adjustments):
+            flash('Fracasó el intento de actualizar el inventario. Si el error persiste, contacta a un administrador.', 'error')
+            return jsonify({'redirect_url': url_for('shop.update_product_quantities')})
+        
+        update_quantities_action = AdminAction(action="Actualizar cantidades de inventario", status='Completado', admin=current_user)
+        if failed_items:
+            failed_skus = df.loc[df['inventoryItemId'].isin(failed_items), 'sku'].to_list()
+            flash('No se pudieron actualizar las cantidades de los siguientes productos. '
+                  f'Por favor actualízalas a mano. \nskus: {", ".join(failed_skus)}', 'error')
+            update_quantities_action.status = 'Incompleto'
+            update_quantities_action.errors = ','.join(failed_skus)[:256]
+        else:
+            flash("Se actualizaron las cantidades correctamente.")
+        db.session.add(update_quantities_action)
+        db.session.commit()
 
     # UPDATE PRODUCT PRICE
     price_changes = df.loc[~df['newPrice'].isna()]
@@ -277,17 +370,17 @@ def upload_product_quantities():
     #clear_inventory_updates_sheet()
 
     # UPDATE COST HISTORY METAFIELD
-    cost_histories = df['costHistory'].to_list()
-    for i in range(len(cost_histories)):
-        cost_histories[i] = json.loads(cost_histories[i])
+    cost_histories = df['costHistory'].dropna().to_list()
     update_cost_history_action = AdminAction(action="Actualizar historial de costos (variant metafield)", status='En progreso', admin=current_user)
     db.session.add(update_cost_history_action)
     db.session.commit()
-    try:
-        set_metafields(cost_histories)
-    except:
-        flash('Hubieron errores al actualizar el metafield "cost history"', 'error')
+    report = set_metafields(cost_histories)
+    if report['failed_owner_ids']:
+        failed_skus = df.loc[df['variantId'].isin(report['failed_owner_ids']), 'sku'].to_list()
+        flash('Hubieron errores al actualizar el metafield "cost history" de '
+              f'los siguientes productos: {", ".join(failed_skus)}', 'error')
         update_cost_history_action.status = 'Incompleto'
+        update_cost_history_action.errors = ','.join(failed_skus)[:256]
     else:
         flash("Se actualizaron los metafields correctamente")
         update_cost_history_action.status = 'Completado'
@@ -305,13 +398,17 @@ def review_new_products():
     upload_form.submit.label.text = 'Subir a Shopify'
 
     if request.method == 'GET': #only refresh form tagets this endpoint
-        df = get_captura() # TODO make async
+        file_form = BatchFileForm()
+        df, staged_filename = get_staged_captura()
+        if df is None:
+            df = get_captura() # TODO make async
     
         column_list = ['rowNum', 'vendor', 'title', 'sku', 'cost', 'price', 'quantityDelta', 'dateOfPurchase']
 
         if df.shape[0] == 0:
             return render_template('shop/captura.html', title='Captura', 
-                                   refresh_form=refresh_form, column_list=column_list)
+                                   refresh_form=refresh_form, file_form=file_form,
+                                   staged_filename=staged_filename, column_list=column_list)
 
         products = captura_cleanup_and_validation(df)
         total_warnings = products['warnings'].count()
@@ -320,13 +417,36 @@ def review_new_products():
         
         return render_template('shop/captura.html', title='Captura', 
                                refresh_form=refresh_form, upload_form=upload_form,
+                               file_form=file_form, staged_filename=staged_filename,
                                products=products_dict, column_list=column_list, 
                                errors=total_errors, warnings=total_warnings)
     
     if refresh_form.validate_on_submit():
-        print('refresh clicked')
+        # back to the Captura worksheet if a file was loaded
+        delete_staged_captura()
         return redirect(url_for('shop.review_new_products'))
 
+@bp.route('/captura-archivo', methods=['POST'])
+@login_required
+def upload_captura_file():
+    '''Loads the products from a CSV/XLSX file instead of the Captura worksheet.'''
+    file_form = BatchFileForm()
+    if not file_form.validate_on_submit():
+        for error in file_form.file.errors:
+            flash(error, 'error')
+        return redirect(url_for('shop.review_new_products'))
+
+    file = file_form.file.data
+    try:
+        total = stage_captura(file.stream, file.filename)
+    except BatchFileError as e:
+        current_app.logger.warning(e)
+        flash(f'No se pudo leer el archivo "{file.filename}".', 'error')
+    else:
+        flash(f'Se cargaron {total} productos del archivo "{file.filename}".')
+
+    return redirect(url_for('shop.review_new_products'))
+
 @bp.route('/captura-cargando', methods=['POST'])
 @login_required
 def start_upload_new_products():
@@ -349,7 +469,9 @@ def upload_new_products():
         flash("Tu usuario no tiene los permisos necesarios para realizar esta acción.", 'warning')
         return redirect(url_for('shop.review_new_products'))
     
-    df = get_captura()
+    df, staged_filename = get_staged_captura()
+    if df is None:
+        df = get_captura()
     if df.shape[0] == 0:
         flash('There are no products to upload')
         return redirect(url_for('dashboard.index'))
@@ -395,21 +517,12 @@ def upload_new_products():
     # captura_path = os.path.join(current_app.config['DATA_DIR'], 'captura')
     # os.makedirs(captura_path, exist_ok=True)
 
-    # add files to the AdminAction
-    storage = storage_service()
-
-    raw_csv_path = f'captura/raw_products{timestamp}.csv'
-    storage.upload_csv(raw_csv_path, df)
-    raw_csv_file = File(path=raw_csv_path, admin_action=publish_products_action)
-    db.session.add(raw_csv_file)
-    db.session.commit()
-
-    # add files to the AdminAction
-    processed_csv_path = f'captura/processed_products{timestamp}.csv'
-    storage.upload_csv(processed_csv_path, products)
-    processed_csv_file = File(path=processed_csv_path, admin_action=publish_products_action)
-    db.session.add(processed_csv_file)
-    db.session.commit()
+    # add files to the AdminAction (uploaded in the background)
+    archive = archive_queue()
+    archive.submit(f'captura/raw_products{timestamp}.csv', df, 
+                   admin_action_id=publish_products_action.id)
+    archive.submit(f'captura/processed_products{timestamp}.csv', products, 
+                   admin_action_id=publish_products_action.id)
 
     try:
         upload_to_shopify(products)
@@ -422,8 +535,14 @@ def upload_new_products():
         Metadata.set_last_product_handle(products.iloc[-1]['handle'])
 
         captura_id = current_app.config['GSHEETS_CAPTURA_ID']
-        append_df_to_sheet(captura_id, 'Historial', products)
-        clear_sheet_except_header(captura_id, 'Captura')
+        batch = SheetBatch(captura_id).append_df('Historial', products)
+        if not staged_filename:
+            # same request as the append, so Captura is never left without its header
+            batch.clear_except_header('Captura')
+        batch.commit()
+        if staged_filename:
+            # only once Historial has the products, so a failed commit can be retried
+            delete_staged_captura()
         publish_products_action.status = "Completado"
         db.session.add(publish_products_action)
         db.session.commit()
@@ -0,0 +1,79 @@
+# Variant records (as returned by inventory.get_variants_by_sku) kept for
+# VARIANT_CACHE_TTL seconds, so that looking up the same SKUs again (e.g. on
+# every refresh of 'Actualizar Cantidades') doesn't query Shopify. Our own
+# mutations update or drop the records they change (see inventory.py).
+#
+# The cache lives in each process.
+
+import copy
+from threading import Lock
+from cachetools import TTLCache
+from flask import current_app
+
+MAX_VARIANTS = 4096
+
+_variants = None # variantId: record
+_skus = None # sku: list of variantIds, only from complete lookups by sku
+_lock = Lock()
+
+def _caches() -> tuple[TTLCache, TTLCache]:
+    '''Call with _lock held.'''
+    global _variants, _skus
+    if _variants is None:
+        ttl = current_app.config['VARIANT_CACHE_TTL']
+        _variants = TTLCache(maxsize=MAX_VARIANTS, ttl=ttl)
+        _skus = TTLCache(maxsize=MAX_VARIANTS, ttl=ttl)
+    return _variants, _skus
+
+def get_by_sku(sku: str) -> list[dict] | None:
+    '''
+    Cached records of every variant with this SKU, or None if they are not all
+    cached. SKUs without variants are not cached, so products created since
+    are found.
+    '''
+    with _lock:
+        variants, skus = _caches()
+        ids = skus.get(sku)
+        if not ids or any(id not in variants for id in ids):
+            return None
+        return [copy.deepcopy(variants[id]) for id in ids]
+
+def store_sku(sku: str, records: list[dict]) -> None:
+    '''Caches the result of a lookup of every variant with this SKU.'''
+    if not records:
+        return
+    with _lock:
+        variants, skus = _caches()
+        for record in records:
+            variants[record['variantId']] = copy.deepcopy(record)
+        skus[sku] = [record['variantId'] for record in records]
+
+def update_variant(variant_id: str, **fields) -> None:
+    '''Updates fields of a cached record, e.g. after changing them in Shopify.'''
+    with _lock:
+        variants, _ = _caches()
+        record = variants.get(variant_id)
+        if record is not None:
+            # assigning again also restarts its ttl
+            variants[variant_id] = {**record, **fields}
+
+def variant_ids_of_items(inventory_item_ids) -> list[str]:
+    '''Ids of the cached variants of these inventory items.'''
+    inventory_item_ids = set(inventory_item_ids)
+    with _lock:
+        variants, _ = _caches()
+        return [id for id, record in variants.items()
+                if record['inventoryItemId'] in inventory_item_ids]
+
+def forget_variants(variant_ids) -> None:
+    '''Drops records, e.g. when a mutation changed them in a way we can't replicate.'''
+    with _lock:
+        variants, _ = _caches()
+        for id in variant_ids:
+            variants.pop(id, None)
+
+def clear_variant_cache() -> None:
+    with _lock:
+        if _variants is not None:
+            _variants.clear()
+            _skus.clear()
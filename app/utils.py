@@ -75,4 +75,4 @@ def validate_spanish_characters(string: str) -> bool:
     return re.fullmatch(valid_chars, string) is not None
 
 def get_timestamp() -> float:
-    return datetime.now(timezone.utc).timestamp()
\ No newline at end of file
+    return datetime.now(timezone.utc).timestamp()
@@ -1,5 +1,6 @@
 import os
 import json
+import tempfile
 import base64
 
 class Config:
@@ -14,6 +15,8 @@ class Config:
     DATA_DIR = os.path.join(basedir, 'data/')
     # some deployments require logging to stdout
     LOG_TO_STDOUT = os.getenv('LOG_TO_STDOUT', '').lower() not in ['0', 'False']
+    # largest request body accepted, e.g. CSV/XLSX batch files
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_UPLOAD_MB') or 32) * 1024 * 1024
 
     # Database
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
@@ -24,14 +27,31 @@ class Config:
     SHOPIFY_STORE = os.getenv('SHOPIFY_STORE')
     SHOPIFY_LOCATION_ID = os.getenv('SHOPIFY_LOCATION_ID') 
     SHOPIFY_API_TOKEN = os.getenv('SHOPIFY_API_TOKEN') 
+    # seconds that variants read from Shopify are reused (see app/shop/variant_cache.py)
+    VARIANT_CACHE_TTL = int(os.getenv('VARIANT_CACHE_TTL') or 600)
 
     # Google Sheets
     gsheets_creds = os.getenv("GSHEETS_CREDENTIALS_BASE64")
     GSHEETS_CREDENTIALS = json.loads(base64.b64decode(gsheets_creds).decode("utf-8")) \
         if gsheets_creds else None
     GSHEETS_CAPTURA_ID = os.getenv('GSHEETS_CAPTURA_ID')
+    # spreadsheet behind the 'actualizarCantidades' Sheety project. Optional, 
+    # used to detect changes before fetching from Sheety.
+    GSHEETS_CANTIDADES_ID = os.getenv('GSHEETS_CANTIDADES_ID')
+    # same for the 'etiquetas' Sheety project
+    GSHEETS_ETIQUETAS_ID = os.getenv('GSHEETS_ETIQUETAS_ID')
+    # seconds that opened spreadsheets/worksheets are reused
+    GSHEETS_HANDLE_TTL = int(os.getenv('GSHEETS_HANDLE_TTL') or 300)
     SHEETY_USERNAME=os.getenv('SHEETY_USERNAME')
     SHEETY_BEARER=os.getenv('SHEETY_BEARER')
+    # seconds to wait for a Sheety response
+    SHEETY_TIMEOUT = int(os.getenv('SHEETY_TIMEOUT') or 30)
+
+    # Price tags
+    # processes used to render label PDFs (at most one per CPU), only for runs 
+    # of at least LABELS_PARALLEL_MIN_LABELS labels (see price_tags.py)
+    LABELS_MAX_WORKERS = int(os.getenv('LABELS_MAX_WORKERS') or 1)
+    LABELS_PARALLEL_MIN_LABELS = int(os.getenv('LABELS_PARALLEL_MIN_LABELS') or 30000)
 
     # email configuration
     MAIL_SERVER = os.getenv('MAIL_SERVER')
@@ -47,6 +67,19 @@ class Config:
     AWS_SECRET_KEY = os.getenv('AWS_SECRET_KEY')
     AWS_REGION = os.getenv('AWS_REGION')
     AWS_BUCKET_NAME = os.getenv('AWS_BUCKET_NAME')
+    STORAGE_MAX_POOL_CONNECTIONS = int(os.getenv('STORAGE_MAX_POOL_CONNECTIONS') or 10)
+    STORAGE_MAX_ATTEMPTS = int(os.getenv('STORAGE_MAX_ATTEMPTS') or 5)
+    STORAGE_MULTIPART_THRESHOLD = int(os.getenv('STORAGE_MULTIPART_THRESHOLD') or 16 * 1024 * 1024)
+    STORAGE_MULTIPART_CHUNKSIZE = int(os.getenv('STORAGE_MULTIPART_CHUNKSIZE') or 8 * 1024 * 1024)
+    # local disk cache for S3 downloads. Set max bytes to 0 to disable
+    STORAGE_CACHE_DIR = os.getenv('STORAGE_CACHE_DIR') or \
+        os.path.join(tempfile.gettempdir(), 'cdl-admin-storage-cache')
+    STORAGE_CACHE_MAX_BYTES = int(os.getenv('STORAGE_CACHE_MAX_BYTES') or 256 * 1024 * 1024)
+
+    # Archiving of files in the background (see app/archive.py)
+    ARCHIVE_MAX_ATTEMPTS = int(os.getenv('ARCHIVE_MAX_ATTEMPTS') or 5)
+    # 'gzip', 'zstd' (requires the zstandard package) or 'none'
+    ARCHIVE_COMPRESSION = os.getenv('ARCHIVE_COMPRESSION') or 'gzip'
 
     # External links
     URL_WORKLOG=os.getenv('URL_WORKLOG')
@@ -55,3 +88,6 @@ class Config:
     # Customize app:
     ADMIN_ACTIONS_PER_PAGE = 50
     VENDORS_PER_PAGE = 50
+    PRODUCTS_PER_PAGE = 50
+    # minimum seconds between writes of a user's last_seen
+    LAST_SEEN_INTERVAL = int(os.getenv('LAST_SEEN_INTERVAL') or 300)